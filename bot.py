@@ -1,5 +1,9 @@
 # -------------- bot.py (исправленная версия 3.1 - БЕЗ ОШИБОК) --------------
-import discord, json, os, asyncio, re
+import discord, aiohttp, json, os, asyncio, re, signal, sqlite3, time, bisect, heapq, random, multiprocessing
+import csv, gzip, io, tempfile
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime, timedelta, timezone
 from discord.ext import tasks
 from discord import app_commands
@@ -25,12 +29,47 @@ tree = app_commands.CommandTree(client)
 
 DB_STATS = "stats.json"
 DB_CAPTS = "capts.json"
+DB_JOURNAL = "capts.journal"
+DB_BOARDS = "boards.json"  # ID сообщений с табло по каналам
+DB_SQLITE = "stats.db"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")  # "json" или "sqlite"
+FLUSH_DELAY = 5  # Секунд до записи изменений на диск
+GROUP_COMMIT_DELAY = 0.005  # Секунд ожидания попутных изменений перед записью в журнал
+JOURNAL_COMPACT_SIZE = 500  # Записей в журнале до сжатия в снимок
+FORM_SIZE = 20  # Последних игр игрока в буфере формы (наибольшее last_n)
+SKETCH_K = 128  # Точность скетчей квантилей урона (до стольких значений - точно)
+MEMBER_CACHE_TTL = 6 * 3600  # Секунд хранения имени участника
+MEMBER_CACHE_SIZE = 5000  # Максимум имён в кэше
+MEMBER_QUERY_BATCH = 100  # ID за один запрос участников через шлюз (лимит Discord)
+MEMBER_FETCH_CONCURRENCY = 5  # Параллельных REST-запросов, если шлюз не ответил
+REFRESH_DELAY = 3  # Секунд на объединение запросов обновления табло
+EXPORT_CHUNK_ROWS = 1000  # Строк выгрузки, записываемых за раз
+EXPORT_SPOOL_SIZE = 8 * 1024 * 1024  # Байт сжатой выгрузки в памяти, дальше - во временном файле
+AUTOCOMPLETE_RECENT_CAPTS = 200  # Последних каптов, среди которых ищет автодополнение номера
+RENDER_CACHE_SIZE = 64  # Готовых embed'ов команд просмотра в кэше
+BOARD_TIMESTAMP_REFRESH = 24 * 3600  # Секунд, после которых неизменное табло переписывается ради времени
+UPLOAD_PROGRESS_INTERVAL = 2  # Секунд между сообщениями о ходе загрузки каптов
+UPLOAD_CHUNK_LINES = 2000  # Строк файла каптов на одну задачу разбора
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", "2"))  # Процессов для тяжёлых вычислений (0 - без пула)
 
 # ==================== УТИЛИТЫ ====================
 def now():
     """Получить текущее время UTC"""
     return datetime.now(timezone.utc)
 
+def write_json_file(path: str, data):
+    """Записать JSON и дождаться его попадания на диск"""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+
+def write_json_atomic(path: str, data):
+    """Записать JSON через временный файл: при сбое старый файл остаётся целым"""
+    tmp = path + ".tmp"
+    write_json_file(tmp, data)
+    os.replace(tmp, path)
+
 def load_stats() -> dict:
     try:
         with open(DB_STATS, "r", encoding="utf-8") as f:
@@ -38,10 +77,6 @@ def load_stats() -> dict:
     except (FileNotFoundError, json.JSONDecodeError):
         return {}
 
-def save_stats(data: dict):
-    with open(DB_STATS, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
 def load_capts() -> list:
     try:
         with open(DB_CAPTS, "r", encoding="utf-8") as f:
@@ -49,9 +84,15 @@ def load_capts() -> list:
     except (FileNotFoundError, json.JSONDecodeError):
         return []
 
-def save_capts(data: list):
-    with open(DB_CAPTS, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def load_boards() -> dict:
+    try:
+        with open(DB_BOARDS, "r", encoding="utf-8") as f:
+            return json.load(f) or {}
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_boards(data: dict):
+    write_json_atomic(DB_BOARDS, data)
 
 def has_role(member: discord.Member, roles):
     return any(r.name in roles for r in member.roles)
@@ -64,14 +105,9 @@ def progress_bar(percent: int, length: int = 10):
 def medal(pos: int) -> str:
     return {1: "🥇", 2: "🥈", 3: "🥉"}.get(pos, "")
 
-def get_capts_in_period(days: int = None):
-    """Получить капты за период"""
-    capts = load_capts()
-    if days is None:
-        return capts
-    
-    cutoff = now() - timedelta(days=days)
-    return [c for c in capts if datetime.fromisoformat(c["date"]).replace(tzinfo=timezone.utc) >= cutoff]
+def period_ranking(days: int = None):
+    """Статистика игроков за период вместе с рейтингами"""
+    return store.ranking(days)
 
 def calculate_stats(capts_list: list) -> dict:
     """Рассчитать статистику из списка каптов"""
@@ -86,6 +122,27 @@ def calculate_stats(capts_list: list) -> dict:
             stats[uid]["games"] += 1
     return stats
 
+_workers = None
+
+async def run_cpu(func, *args):
+    """Выполнить тяжёлое вычисление в пуле процессов, не занимая цикл событий.
+
+    Аргументы и результат передаются между процессами, поэтому это должны
+    быть простые данные. При WORKER_POOL_SIZE = 0 функция вызывается сразу.
+    """
+    global _workers
+    if WORKER_POOL_SIZE <= 0:
+        return func(*args)
+    if _workers is None:
+        # spawn: дочерние процессы не наследуют потоки и соединения бота
+        _workers = ProcessPoolExecutor(WORKER_POOL_SIZE, mp_context=multiprocessing.get_context("spawn"))
+    return await asyncio.get_running_loop().run_in_executor(_workers, func, *args)
+
+def shutdown_workers():
+    """Остановить пул процессов"""
+    if _workers is not None:
+        _workers.shutdown(wait=True)
+
 async def log_action(guild: discord.Guild, user: discord.Member, action: str, details: str = ""):
     """Логирование действий в лог-канал"""
     if not LOG_CHANNEL_ID:
@@ -107,73 +164,1401 @@ async def log_action(guild: discord.Guild, user: discord.Member, action: str, de
     except:
         pass
 
-# ==================== VIEW ДЛЯ СПИСКА КАПТОВ ====================
-class CaptsListView(View):
-    def __init__(self, guild: discord.Guild, period: str = "all"):
-        super().__init__(timeout=None)
-        self.guild = guild
-        self.period = period
-        self.current_page = 0
-        self.capts_per_page = 10
-        self.update_data()
-
-    def update_data(self):
-        if self.period == "week":
-            self.capts = get_capts_in_period(7)
-        elif self.period == "month":
-            self.capts = get_capts_in_period(30)
+# ==================== ХРАНИЛИЩЕ ====================
+def parse_capt_date(date: str) -> datetime:
+    """Дата капта из ISO-строки (даты без пояса считаются UTC)"""
+    return datetime.fromisoformat(date).replace(tzinfo=timezone.utc)
+
+def capt_ts(date: str) -> float:
+    """Метка времени капта"""
+    return parse_capt_date(date).timestamp()
+
+def normalize_name(name: str) -> str:
+    """Имя семьи или участника для сравнения: без регистра и лишних пробелов"""
+    return " ".join(name.casefold().split())
+
+class JsonBackend:
+    """Снимок в stats.json / capts.json и журнал изменений capts.journal.
+
+    Каждое изменение дописывается в журнал одной строкой; снимок
+    перезаписывается только при сжатии журнала. Методы load/append/commit
+    выполняются в потоке хранилища, prepare - в цикле событий.
+
+    Сжатие атомарно для обоих файлов снимка: новые версии пишутся рядом
+    (*.new), затем создаётся метка сжатия. Есть метка - снимок полный, и
+    замена файлов с очисткой журнала доводится до конца (в том числе при
+    следующем запуске); нет метки - действуют старый снимок и весь журнал.
+    """
+
+    SNAPSHOT_FILES = (DB_CAPTS, DB_STATS)
+    needs_migration = False
+
+    def __init__(self, journal_path: str):
+        self.journal_path = journal_path
+        self.marker_path = journal_path + ".compact"
+        self.journal = None
+        self.entries = 0
+
+    def _finish_compaction(self):
+        """Заменить файлы снимка новыми версиями и очистить журнал"""
+        for path in self.SNAPSHOT_FILES:
+            if os.path.exists(path + ".new"):
+                os.replace(path + ".new", path)
+        if self.journal is None:
+            with open(self.journal_path, "w", encoding="utf-8") as f:
+                os.fsync(f.fileno())
         else:
-            self.capts = load_capts()
-        
-        self.total_pages = max(1, (len(self.capts) + self.capts_per_page - 1) // self.capts_per_page)
-        if self.current_page >= self.total_pages:
-            self.current_page = max(0, self.total_pages - 1)
-
-    @discord.ui.button(label="⬅️", style=discord.ButtonStyle.secondary, custom_id="capts_prev")
-    async def previous_page(self, interaction: discord.Interaction, button: Button):
-        if self.current_page > 0:
-            self.current_page -= 1
-            await self.update_message(interaction)
+            self.journal.truncate(0)
+            os.fsync(self.journal.fileno())
+        self.entries = 0
+        os.remove(self.marker_path)
+
+    def load(self):
+        if os.path.exists(self.marker_path):
+            # Сбой во время сжатия после того, как снимок был записан целиком
+            self._finish_compaction()
+            print("📒 Завершено прерванное сжатие журнала")
         else:
-            await interaction.response.defer()
+            # Недописанный снимок без метки не действует
+            for path in self.SNAPSHOT_FILES:
+                if os.path.exists(path + ".new"):
+                    os.remove(path + ".new")
+
+        try:
+            with open(self.journal_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            # Недописанная последняя строка после сбоя: отрезаем её, иначе
+            # следующая запись склеится с ней и пропадёт при загрузке
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(end)
+                os.fsync(f.fileno())
+            print("⚠️ Отброшена недописанная запись журнала")
+        # Повреждённая строка внутри журнала - ошибка, а не след сбоя
+        changes = [json.loads(line) for line in data[:end].decode("utf-8").splitlines() if line]
+        self.journal = open(self.journal_path, "a", encoding="utf-8")
+        self.entries = len(changes)
+        return load_capts(), load_stats(), changes
+
+    def append(self, changes: list):
+        # Пачка изменений - одна запись и один fsync
+        self.journal.write("".join(
+            json.dumps(change, ensure_ascii=False, separators=(",", ":")) + "\n" for change in changes
+        ))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.entries += len(changes)
+
+    def prepare(self, store, compact: bool):
+        """Копия данных для записи или None, если сжимать журнал рано"""
+        if not compact and self.entries < JOURNAL_COMPACT_SIZE:
+            return None
+        return store.snapshot()
+
+    def commit(self, snapshot, changes: list):
+        if snapshot is None:
+            return
+        capts, stats = snapshot
+        write_json_file(DB_CAPTS + ".new", capts)
+        write_json_file(DB_STATS + ".new", stats)
+        # С этого момента снимок считается записанным
+        write_json_atomic(self.marker_path, {"files": list(self.SNAPSHOT_FILES)})
+        self._finish_compaction()
+
+class SqliteBackend:
+    """Хранение в SQLite: капты, игроки каптов и итоговая статистика.
+
+    Выборки за период и топы считаются по индексам в памяти, база только
+    загружается целиком при старте, поэтому из индексов нужен лишь
+    players(capt_id) для удаления каптов. Соединение создаётся и
+    используется только в потоке хранилища.
+    """
+
+    VERSION = 2  # PRAGMA user_version
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS capts (
+            id   INTEGER PRIMARY KEY,
+            vs   TEXT NOT NULL,
+            date TEXT NOT NULL,
+            win  INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS players (
+            id        INTEGER PRIMARY KEY,
+            capt_id   INTEGER NOT NULL REFERENCES capts(id) ON DELETE CASCADE,
+            user_id   INTEGER NOT NULL,
+            user_name TEXT NOT NULL,
+            damage    INTEGER NOT NULL,
+            kills     INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS stats (
+            user_id TEXT PRIMARY KEY,
+            damage  INTEGER NOT NULL,
+            kills   INTEGER NOT NULL,
+            games   INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_players_capt ON players(capt_id);
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = None
+        self.needs_migration = False
+
+    def load(self):
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.executescript(self.SCHEMA)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version == 1:
+            # Версия 1: столбец ts и индексы по дате, противнику и игроку
+            # ничем не читались и только замедляли запись
+            with self.db:
+                for index in ("idx_capts_date", "idx_capts_vs", "idx_players_user"):
+                    self.db.execute(f"DROP INDEX IF EXISTS {index}")
+                self.db.execute("ALTER TABLE capts DROP COLUMN ts")
+                self.db.execute(f"PRAGMA user_version = {self.VERSION}")
+        elif version == 0:
+            # База новая: данные берутся из JSON вместе с журналом и прерванным
+            # сжатием, Store применяет журнал и передаёт итог в migrate
+            json_backend = JsonBackend(DB_JOURNAL)
+            try:
+                loaded = json_backend.load()
+            finally:
+                if json_backend.journal is not None:
+                    json_backend.journal.close()
+            self.needs_migration = True
+            return loaded
+
+        capts = []
+        by_id = {}
+        for cid, vs, date, win in self.db.execute("SELECT id, vs, date, win FROM capts ORDER BY id"):
+            capt = {"id": cid, "vs": vs, "date": date, "win": bool(win), "players": []}
+            capts.append(capt)
+            by_id[cid] = capt
+        for cid, user_id, user_name, damage, kills in self.db.execute(
+            "SELECT capt_id, user_id, user_name, damage, kills FROM players ORDER BY id"
+        ):
+            by_id[cid]["players"].append({"user_id": user_id, "user_name": user_name, "damage": damage, "kills": kills})
+
+        stats = {
+            uid: {"damage": damage, "kills": kills, "games": games}
+            for uid, damage, kills, games in self.db.execute("SELECT user_id, damage, kills, games FROM stats")
+        }
+        return capts, stats, []
+
+    def migrate(self, snapshot):
+        """Разовый перенос данных из JSON (снимок после применения журнала)"""
+        capts, stats = snapshot
+        with self.db:
+            for capt in capts:
+                self._insert_capt(capt)
+            self.db.executemany(
+                "INSERT INTO stats VALUES (?, ?, ?, ?)",
+                [(uid, d["damage"], d["kills"], d["games"]) for uid, d in stats.items()]
+            )
+            self.db.execute(f"PRAGMA user_version = {self.VERSION}")
+        if capts or stats:
+            print(f"📦 Перенесено в SQLite: {len(capts)} каптов, {len(stats)} записей")
+        self.needs_migration = False
+
+    def _insert_capt(self, capt: dict):
+        self.db.execute(
+            "INSERT INTO capts (id, vs, date, win) VALUES (?, ?, ?, ?)",
+            (capt["id"], capt["vs"], capt["date"], int(capt["win"]))
+        )
+        for player in capt["players"]:
+            self._insert_player(capt["id"], player)
+
+    def _insert_player(self, capt_id: int, player: dict):
+        self.db.execute(
+            "INSERT INTO players (capt_id, user_id, user_name, damage, kills) VALUES (?, ?, ?, ?, ?)",
+            (capt_id, player["user_id"], player["user_name"], player["damage"], player["kills"])
+        )
+
+    def append(self, changes: list):
+        # SQLite сам ведёт журнал (WAL), изменения пишутся транзакцией в commit
+        pass
+
+    def prepare(self, store, compact: bool):
+        # Нужна только статистика: капты пишутся из самих операций
+        return {uid: dict(data) for uid, data in store.stats.items()}
+
+    def commit(self, stats: dict, changes: list):
+        touched = set()
+        with self.db:
+            for change in changes:
+                op = change["op"]
+                if op == "add_capt":
+                    self._insert_capt(change["capt"])
+                    touched.update(str(p["user_id"]) for p in change["capt"]["players"])
+                elif op == "add_capts":
+                    for capt in change["capts"]:
+                        self._insert_capt(capt)
+                        touched.update(str(p["user_id"]) for p in capt["players"])
+                elif op == "add_player":
+                    self._insert_player(change["capt_id"], change["player"])
+                    touched.add(str(change["player"]["user_id"]))
+                elif op == "add_players":
+                    for player in change["players"]:
+                        self._insert_player(change["capt_id"], player)
+                        touched.add(str(player["user_id"]))
+                elif op == "delete_capt":
+                    touched.update(str(uid) for uid, in self.db.execute(
+                        "SELECT user_id FROM players WHERE capt_id = ?", (change["capt_id"],)
+                    ))
+                    self.db.execute("DELETE FROM capts WHERE id = ?", (change["capt_id"],))
+                elif op == "reset":
+                    self.db.execute("DELETE FROM capts")
+                    self.db.execute("DELETE FROM stats")
+                elif op == "remove_stats":
+                    touched.add(change["user_id"])
+
+            # Строки статистики переписываются из памяти - там уже итоговые значения
+            for uid in touched:
+                data = stats.get(uid)
+                if data is None:
+                    self.db.execute("DELETE FROM stats WHERE user_id = ?", (uid,))
+                else:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?)",
+                        (uid, data["damage"], data["kills"], data["games"])
+                    )
+
+DAY = 86400  # Секунд в сутках (границы дней - по UTC)
+
+def aggregate_capts(capts: list):
+    """Итоги игроков за всё время и по дням: (итоги, {день: итоги})"""
+    by_day = {}
+    for capt in capts:
+        by_day.setdefault(int(capt_ts(capt["date"]) // DAY), []).append(capt)
+    return calculate_stats(capts), {day: calculate_stats(group) for day, group in by_day.items()}
+
+class KLLSketch:
+    """Сливаемый скетч квантилей (KLL): память O(SKETCH_K) при любом числе значений.
+
+    Уровень h хранит значения с весом 2^h; переполненный уровень
+    сортируется, и каждое второе значение уходит на уровень выше.
+    """
+
+    __slots__ = ("levels", "size")
+
+    def __init__(self):
+        self.levels = [[]]
+        self.size = 0
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self.levels) - level - 1
+        return int(SKETCH_K * (2 / 3) ** depth) + 2
+
+    def _max_size(self) -> int:
+        return sum(self._capacity(h) for h in range(len(self.levels)))
+
+    def update(self, value):
+        self.levels[0].append(value)
+        self.size += 1
+        if self.size >= self._max_size():
+            self._compress()
+
+    def merge(self, other: "KLLSketch"):
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for level, items in zip(self.levels, other.levels):
+            level.extend(items)
+        self.size += other.size
+        while self.size >= self._max_size():
+            self._compress()
+
+    def _compress(self):
+        for h in range(len(self.levels)):
+            items = self.levels[h]
+            if len(items) < self._capacity(h):
+                continue
+            if h + 1 == len(self.levels):
+                self.levels.append([])
+            items.sort()
+            rest = [items.pop()] if len(items) % 2 else []
+            self.levels[h + 1].extend(items[random.getrandbits(1)::2])
+            self.levels[h] = rest
+            self.size = sum(len(level) for level in self.levels)
+            if self.size < self._max_size():
+                break
+
+    def quantile(self, q: float):
+        """Значение квантиля q (0..1) или None для пустого скетча"""
+        weighted = sorted((value, 1 << h) for h, level in enumerate(self.levels) for value in level)
+        if not weighted:
+            return None
+        target = q * sum(weight for _, weight in weighted)
+        passed = 0
+        for value, weight in weighted:
+            passed += weight
+            if passed >= target:
+                return value
+        return weighted[-1][0]
+
+class DailyStats:
+    """Статистика игроков по дням для быстрых запросов за период.
+
+    Итоги за всё время ведутся отдельно; период складывается из целых дней
+    после границы и каптов самого граничного дня, попавших в период. Так же
+    по дням и за всё время хранятся скетчи квантилей урона (игроков и клана).
+    """
+
+    def __init__(self):
+        self.totals = {}  # user_id -> {"damage", "kills", "games"}
+        self.days = {}    # день -> {user_id -> {"damage", "kills", "games"}}
+        self.capts = {}   # день -> [(метка времени, капт)]
+        self.results = {} # день -> [каптов, побед]
+        self.total_capts = 0
+        self.total_wins = 0
+        self._keys = []   # отсортированные дни, в которые были капты
+        self.clan_days = {}    # день -> KLLSketch урона всех игроков
+        self.player_days = {}  # день -> {user_id -> KLLSketch}
+        self.clan_all = KLLSketch()
+        self.player_all = {}   # user_id -> KLLSketch
+
+    def add_capt(self, capt: dict, ts: float, count_players: bool = True):
+        day = int(ts // DAY)
+        if day not in self.capts:
+            self.capts[day] = []
+            self.days[day] = {}
+            self.results[day] = [0, 0]
+            self.clan_days[day] = KLLSketch()
+            self.player_days[day] = {}
+            bisect.insort(self._keys, day)
+        self.capts[day].append((ts, capt))
+        self._count_result(day, capt, 1)
+        for player in capt["players"]:
+            if count_players:
+                self.add_player(ts, player, 1)
+            else:
+                self._sketch(day, player)
 
-    @discord.ui.button(label="1/1", style=discord.ButtonStyle.primary, custom_id="capts_page")
-    async def page_info(self, interaction: discord.Interaction, button: Button):
-        await interaction.response.defer()
+    def load_players(self, totals: dict, days: dict):
+        """Подставить заранее посчитанные итоги игроков (см. aggregate_capts)"""
+        self.totals.update(totals)
+        for day, data in days.items():
+            self.days[day].update(data)
 
-    @discord.ui.button(label="➡️", style=discord.ButtonStyle.secondary, custom_id="capts_next")
-    async def next_page(self, interaction: discord.Interaction, button: Button):
-        if self.current_page < self.total_pages - 1:
-            self.current_page += 1
-            await self.update_message(interaction)
+    def remove_capt(self, capt: dict, ts: float):
+        day = int(ts // DAY)
+        for player in capt["players"]:
+            self.add_player(ts, player, -1)
+        self.capts[day] = [(t, c) for t, c in self.capts[day] if c is not capt]
+        self._count_result(day, capt, -1)
+        if not self.capts[day]:
+            del self.capts[day]
+            del self.days[day]
+            del self.results[day]
+            del self.clan_days[day]
+            del self.player_days[day]
+            self._keys.pop(bisect.bisect_left(self._keys, day))
+        self._rebuild_sketches(day, {str(p["user_id"]) for p in capt["players"]})
+
+    def _sketch(self, day: int, player: dict):
+        uid = str(player["user_id"])
+        self.clan_days[day].update(player["damage"])
+        self.clan_all.update(player["damage"])
+        for sketches in (self.player_days[day], self.player_all):
+            if uid not in sketches:
+                sketches[uid] = KLLSketch()
+            sketches[uid].update(player["damage"])
+
+    def _rebuild_sketches(self, day: int, uids: set):
+        """Скетчи не умеют удалять значения: пересобираем день и затронутые итоги"""
+        if day in self.capts:
+            self.clan_days[day] = KLLSketch()
+            self.player_days[day] = {}
+            for _, capt in self.capts[day]:
+                for player in capt["players"]:
+                    self.clan_days[day].update(player["damage"])
+                    self.player_days[day].setdefault(str(player["user_id"]), KLLSketch()).update(player["damage"])
+        self.clan_all = KLLSketch()
+        for uid in uids:
+            self.player_all.pop(uid, None)
+        for key in self._keys:
+            self.clan_all.merge(self.clan_days[key])
+            for uid in uids:
+                sketch = self.player_days[key].get(uid)
+                if sketch is not None:
+                    self.player_all.setdefault(uid, KLLSketch()).merge(sketch)
+
+    def sketches_since(self, ts: float = None) -> dict:
+        """Скетчи урона игроков с момента ts (None - за всё время)"""
+        if ts is None:
+            return self.player_all
+        players = {}
+        first_day = int(ts // DAY)
+        for t, capt in self.capts.get(first_day, ()):
+            if t >= ts:
+                for player in capt["players"]:
+                    players.setdefault(str(player["user_id"]), KLLSketch()).update(player["damage"])
+        for day in self._keys[bisect.bisect_right(self._keys, first_day):]:
+            for uid, sketch in self.player_days[day].items():
+                players.setdefault(uid, KLLSketch()).merge(sketch)
+        return players
+
+    def clan_sketch_since(self, ts: float = None) -> KLLSketch:
+        """Скетч урона всех игроков с момента ts"""
+        if ts is None:
+            return self.clan_all
+        clan = KLLSketch()
+        first_day = int(ts // DAY)
+        for t, capt in self.capts.get(first_day, ()):
+            if t >= ts:
+                for player in capt["players"]:
+                    clan.update(player["damage"])
+        for day in self._keys[bisect.bisect_right(self._keys, first_day):]:
+            clan.merge(self.clan_days[day])
+        return clan
+
+    def user_sketch_since(self, uid: str, ts: float = None):
+        """Скетч урона одного игрока с момента ts или None"""
+        if ts is None:
+            return self.player_all.get(uid)
+        sketch = KLLSketch()
+        first_day = int(ts // DAY)
+        for t, capt in self.capts.get(first_day, ()):
+            if t >= ts:
+                for player in capt["players"]:
+                    if str(player["user_id"]) == uid:
+                        sketch.update(player["damage"])
+        for day in self._keys[bisect.bisect_right(self._keys, first_day):]:
+            day_sketch = self.player_days[day].get(uid)
+            if day_sketch is not None:
+                sketch.merge(day_sketch)
+        return sketch if sketch.size else None
+
+    def _count_result(self, day: int, capt: dict, sign: int):
+        win = sign if capt["win"] else 0
+        self.results[day][0] += sign
+        self.results[day][1] += win
+        self.total_capts += sign
+        self.total_wins += win
+
+    def results_since(self, ts: float = None):
+        """(каптов, побед) с момента ts (None - за всё время)"""
+        if ts is None:
+            return self.total_capts, self.total_wins
+        first_day = int(ts // DAY)
+        total = wins = 0
+        for t, capt in self.capts.get(first_day, ()):
+            if t >= ts:
+                total += 1
+                wins += 1 if capt["win"] else 0
+        for day in self._keys[bisect.bisect_right(self._keys, first_day):]:
+            total += self.results[day][0]
+            wins += self.results[day][1]
+        return total, wins
+
+    def add_player(self, ts: float, player: dict, sign: int = 1):
+        uid = str(player["user_id"])
+        for bucket in (self.totals, self.days[int(ts // DAY)]):
+            data = bucket.get(uid)
+            if data is None:
+                data = bucket[uid] = {"damage": 0, "kills": 0, "games": 0}
+            data["damage"] += sign * player["damage"]
+            data["kills"] += sign * player["kills"]
+            data["games"] += sign
+            if data["games"] <= 0:
+                del bucket[uid]
+        if sign > 0:
+            self._sketch(int(ts // DAY), player)
+
+    def since(self, ts: float = None) -> dict:
+        """Статистика игроков с момента ts (None - за всё время)"""
+        if ts is None:
+            return self.totals
+
+        result = {}
+
+        def merge(uid, damage, kills, games):
+            data = result.get(uid)
+            if data is None:
+                data = result[uid] = {"damage": 0, "kills": 0, "games": 0}
+            data["damage"] += damage
+            data["kills"] += kills
+            data["games"] += games
+
+        first_day = int(ts // DAY)
+        for t, capt in self.capts.get(first_day, ()):
+            if t >= ts:
+                for player in capt["players"]:
+                    merge(str(player["user_id"]), player["damage"], player["kills"], 1)
+        for day in self._keys[bisect.bisect_right(self._keys, first_day):]:
+            for uid, data in self.days[day].items():
+                merge(uid, data["damage"], data["kills"], data["games"])
+        return result
+
+    def user_since(self, uid: str, ts: float):
+        """Статистика одного игрока с момента ts или None"""
+        data = {"damage": 0, "kills": 0, "games": 0}
+        first_day = int(ts // DAY)
+        for t, capt in self.capts.get(first_day, ()):
+            if t >= ts:
+                for player in capt["players"]:
+                    if str(player["user_id"]) == uid:
+                        data["damage"] += player["damage"]
+                        data["kills"] += player["kills"]
+                        data["games"] += 1
+        for day in self._keys[bisect.bisect_right(self._keys, first_day):]:
+            day_data = self.days[day].get(uid)
+            if day_data:
+                data["damage"] += day_data["damage"]
+                data["kills"] += day_data["kills"]
+                data["games"] += day_data["games"]
+        return data if data["games"] else None
+
+class RankIndex:
+    """Рейтинг по убыванию значения: место за O(log n), топ-k без сортировки"""
+
+    def __init__(self):
+        self._keys = []    # (-значение, user_id) по возрастанию
+        self._values = {}  # user_id -> значение
+
+    def __len__(self):
+        return len(self._keys)
+
+    def update(self, uid: str, value):
+        """Обновить значение игрока (None - убрать из рейтинга)"""
+        old = self._values.pop(uid, None)
+        if old is not None:
+            self._keys.pop(bisect.bisect_left(self._keys, (-old, uid)))
+        if value is not None:
+            self._values[uid] = value
+            bisect.insort(self._keys, (-value, uid))
+
+    def rank(self, uid: str):
+        """Место игрока (с 1) или None"""
+        value = self._values.get(uid)
+        if value is None:
+            return None
+        return bisect.bisect_left(self._keys, (-value, uid)) + 1
+
+    def top(self, k: int) -> list:
+        return [uid for _, uid in self._keys[:k]]
+
+class FormBuffer:
+    """Кольцевой буфер урона и киллов последних FORM_SIZE игр игрока (по дате)"""
+
+    __slots__ = ("damage", "kills", "head", "count")
+
+    def __init__(self):
+        self.damage = array("q", bytes(8 * FORM_SIZE))
+        self.kills = array("q", bytes(8 * FORM_SIZE))
+        self.head = 0   # куда запишется следующая игра
+        self.count = 0
+
+    def push(self, damage: int, kills: int):
+        self.damage[self.head] = damage
+        self.kills[self.head] = kills
+        self.head = (self.head + 1) % FORM_SIZE
+        self.count = min(self.count + 1, FORM_SIZE)
+
+    def last(self, n: int):
+        """(игр, урон, киллы) за последние n игр"""
+        n = min(n, self.count)
+        damage = kills = 0
+        for i in range(1, n + 1):
+            damage += self.damage[self.head - i]
+            kills += self.kills[self.head - i]
+        return n, damage, kills
+
+class PeriodRanking:
+    """Статистика за период и рейтинги по среднему урону и киллам.
+
+    Для недели/месяца действует, пока граница периода не прошла мимо
+    самого раннего капта в нём (valid_until).
+    """
+
+    def __init__(self, stats: dict, ts: float = None, valid_until: float = float("inf")):
+        self.stats = stats
+        self.ts = ts
+        self.valid_until = valid_until
+        self.avg = RankIndex()
+        self.kills = RankIndex()
+        for uid in stats:
+            self.update(uid)
+
+    def update(self, uid: str):
+        """Пересчитать место игрока после изменения self.stats[uid]"""
+        data = self.stats.get(uid)
+        self.kills.update(uid, data["kills"] if data else None)
+        # В рейтинг по среднему попадают игроки с 3+ играми
+        self.avg.update(uid, data["damage"] / data["games"] if data and data["games"] >= 3 else None)
+
+class Store:
+    """Капты и статистика в памяти с отложенной записью на диск.
+
+    Все изменения описываются словарями-операциями ({"op": ...}). Их
+    применяет одна задача-писатель строго по очереди поступления: всё, что
+    пришло за GROUP_COMMIT_DELAY, попадает в журнал одной записью. Весь
+    дисковый ввод-вывод идёт в отдельном потоке, по очереди.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+        self.capts = []
+        self.stats = {}
+        self.boards = {}
+        self.daily = DailyStats()
+        self._by_id = {}
+        self._dates = {}     # id капта -> разобранная дата
+        self._timeline = []  # (метка времени, id), по возрастанию даты
+        self._summaries = {} # id капта -> [игроков, урон, киллы]
+        self._history = {}   # user_id -> [(метка времени, id капта)], по возрастанию даты
+        self._form = {}      # user_id -> FormBuffer
+        self._opponents = {}     # нормализованное имя семьи -> итоги против неё
+        self._opponent_keys = [] # отсортированные нормализованные имена
+        self._ranking_all = PeriodRanking(self.daily.totals)
+        self._rankings = {}  # дней в периоде -> PeriodRanking
+        self._next_id = 1
+        self._changes = []
+        self._flush_task = None
+        self._queue = None   # (изменение, future) для задачи-писателя
+        self._writer = None
+        self.version = 0     # растёт с каждым применённым изменением
+
+    def _io_call(self, func, *args) -> asyncio.Future:
+        return asyncio.get_running_loop().run_in_executor(self._io, func, *args)
+
+    async def load(self):
+        """Загрузить данные с диска (один раз при старте)"""
+        self.capts, self.stats, journal = await self._io_call(self.backend.load)
+        self.boards = await self._io_call(load_boards)
+        for capt in self.capts:
+            # В старых capts.json у каптов нет id
+            if "id" not in capt:
+                capt["id"] = self._next_id
+            self._next_id = max(self._next_id, capt["id"] + 1)
+        # Итоги по всей истории считаются в пуле процессов
+        totals, days = await run_cpu(aggregate_capts, self.capts)
+        for capt in self.capts:
+            self._index_capt(capt, count_players=False)
+        self.daily.load_players(totals, days)
+
+        for change in journal:
+            # id берутся до применения: _apply убирает из add_capts уже учтённые
+            added = {"add_capt": [change.get("capt")], "add_capts": change.get("capts")}.get(change["op"], ())
+            for capt in added:
+                self._next_id = max(self._next_id, capt["id"] + 1)
+            self._apply(change)
+        if journal:
+            print(f"📒 Из журнала восстановлено изменений: {len(journal)}")
+        if self.backend.needs_migration:
+            await self._io_call(self.backend.migrate, self.snapshot())
+        self._ranking_all = PeriodRanking(self.daily.totals)
+
+    async def _commit(self, change: dict) -> bool:
+        """Передать изменение писателю и дождаться записи; False - не применено"""
+        self._start_writer()
+        done = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((change, done))
+        return await done
+
+    def _start_writer(self):
+        """Запустить писателя, если его нет или он завершился (очередь сохраняется)"""
+        if self._writer is None or self._writer.done():
+            if self._queue is None:
+                self._queue = asyncio.Queue()
+            self._writer = asyncio.get_running_loop().create_task(self._write_loop())
+
+    async def _write_loop(self):
+        # Единственное место, где меняются данные после загрузки
+        while True:
+            batch = [await self._queue.get()]
+            await asyncio.sleep(GROUP_COMMIT_DELAY)
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            stop = None in batch  # сигнал остановки из close()
+            batch = [item for item in batch if item is not None]
+            
+            applied = []
+            results = []
+            for change, done in batch:
+                try:
+                    ok = self._apply(change)
+                except Exception as e:
+                    if not done.done():
+                        done.set_exception(e)
+                    continue
+                if ok:
+                    applied.append(change)
+                    self.version += 1
+                results.append((done, ok))
+            
+            if applied:
+                self._changes += applied
+                if self._flush_task is None or self._flush_task.done():
+                    self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+                try:
+                    await self._io_call(self.backend.append, applied)
+                except Exception as e:
+                    for done, ok in results:
+                        if not done.done():
+                            done.set_exception(e)
+                    results = []
+            for done, ok in results:
+                # Вызвавшую корутину могли отменить - её future уже завершён
+                if not done.done():
+                    done.set_result(ok)
+            if stop:
+                return
+
+    async def _flush_later(self):
+        # Все изменения за FLUSH_DELAY секунд попадают в одну запись
+        await asyncio.sleep(FLUSH_DELAY)
+        await self.flush()
+
+    async def flush(self, compact: bool = False):
+        """Записать накопленные изменения на диск (compact - сжать журнал)"""
+        if not self._changes and not compact:
+            return
+        changes, self._changes = self._changes, []
+        snapshot = self.backend.prepare(self, compact)
+        await self._io_call(self.backend.commit, snapshot, changes)
+
+    async def close(self):
+        """Дописать очередь, сжать журнал и остановить поток хранилища"""
+        if self._queue is not None:
+            self._start_writer()
+            self._queue.put_nowait(None)
+            await self._writer
+        await self.flush(compact=True)
+        self._io.shutdown(wait=True)
+
+    async def set_board_message(self, channel_id: int, message_id: int):
+        """Запомнить сообщение с табло в канале"""
+        self.boards[str(channel_id)] = message_id
+        await self._io_call(save_boards, dict(self.boards))
+
+    def snapshot(self):
+        """Копия данных, которую можно сериализовать вне цикла событий"""
+        capts = [dict(capt, players=list(capt["players"])) for capt in self.capts]
+        stats = {uid: dict(data) for uid, data in self.stats.items()}
+        return capts, stats
+
+    def _apply(self, change: dict) -> bool:
+        """Применить изменение к данным в памяти, False - если оно уже учтено"""
+        # Проверки отсеивают устаревшие операции: игрок уже добавлен
+        # параллельной командой, капт успели удалить и т.п.
+        op = change["op"]
+        if op == "add_capt":
+            if change["capt"]["id"] in self._by_id:
+                return False
+            # Копия: список игроков в операции не должен меняться после записи
+            capt = dict(change["capt"], players=list(change["capt"]["players"]))
+            self.capts.append(capt)
+            self._index_capt(capt)
+            for player in capt["players"]:
+                self._count_player(player, 1)
+            self._rerank(self.capt_ts(capt), capt["players"])
+        elif op == "add_capts":
+            # В журнал и базу попадают только реально добавленные
+            change["capts"] = [c for c in change["capts"] if self._apply({"op": "add_capt", "capt": c})]
+            if not change["capts"]:
+                return False
+        elif op in ("add_player", "add_players"):
+            capt = self._by_id.get(change["capt_id"])
+            if capt is None:
+                return False
+            present = {p["user_id"] for p in capt["players"]}
+            added = []
+            for player in change["players"] if op == "add_players" else [change["player"]]:
+                if player["user_id"] in present:
+                    continue
+                present.add(player["user_id"])
+                added.append(player)
+            if not added:
+                return False
+            if change.get("all") and len(added) < len(change["players"]):
+                # Все или ничего: часть игроков уже добавлена другой командой
+                return False
+            if op == "add_players":
+                # В журнал и базу попадают только реально добавленные
+                change["players"] = added
+            summary = self._summaries[capt["id"]]
+            for player in added:
+                capt["players"].append(player)
+                summary[0] += 1
+                summary[1] += player["damage"]
+                summary[2] += player["kills"]
+                self.daily.add_player(self.capt_ts(capt), player)
+                self._index_player(capt, player)
+                self._count_opponent(capt, 0, player["damage"], player["kills"])
+                self._count_player(player, 1)
+            self._rerank(self.capt_ts(capt), added)
+        elif op == "delete_capt":
+            capt = self._by_id.get(change["capt_id"])
+            if capt is None:
+                return False
+            ts = self.capt_ts(capt)
+            self.capts.remove(capt)
+            self._unindex_capt(capt)
+            for player in capt["players"]:
+                self._count_player(player, -1)
+            self._rerank(ts, capt["players"])
+        elif op == "reset":
+            self.capts = []
+            self.stats = {}
+            self.daily = DailyStats()
+            self._by_id = {}
+            self._dates = {}
+            self._timeline = []
+            self._summaries = {}
+            self._history = {}
+            self._form = {}
+            self._opponents = {}
+            self._opponent_keys = []
+            self._ranking_all = PeriodRanking(self.daily.totals)
+            self._rankings = {}
+        elif op == "remove_stats":
+            if self.stats.pop(change["user_id"], None) is None:
+                return False
+        return True
+
+    def _rerank(self, ts: float, players: list):
+        """Обновить рейтинги игроков капта с меткой времени ts"""
+        uids = {str(p["user_id"]) for p in players}
+        for uid in uids:
+            self._ranking_all.update(uid)
+        for days, ranking in self._rankings.items():
+            if ts < ranking.ts:
+                continue
+            # Капт внутри окна мог оказаться раньше прежнего первого
+            ranking.valid_until = min(ranking.valid_until, ts + days * DAY)
+            for uid in uids:
+                data = self.daily.user_since(uid, ranking.ts)
+                if data is None:
+                    ranking.stats.pop(uid, None)
+                else:
+                    ranking.stats[uid] = data
+                ranking.update(uid)
+
+    def ranking(self, days: int = None) -> PeriodRanking:
+        """Статистика и рейтинги за последние days дней (None - за всё время)"""
+        if days is None:
+            return self._ranking_all
+        current = now().timestamp()
+        ranking = self._rankings.get(days)
+        if ranking is None or current >= ranking.valid_until:
+            ts = current - days * DAY
+            start = bisect.bisect_left(self._timeline, (ts,))
+            valid_until = self._timeline[start][0] + days * DAY if start < len(self._timeline) else float("inf")
+            ranking = self._rankings[days] = PeriodRanking(self.daily.since(ts), ts, valid_until)
+        return ranking
+
+    def _index_capt(self, capt: dict, count_players: bool = True):
+        dt = parse_capt_date(capt["date"])
+        ts = dt.timestamp()
+        self._by_id[capt["id"]] = capt
+        self._dates[capt["id"]] = dt
+        self._summaries[capt["id"]] = [
+            len(capt["players"]),
+            sum(p["damage"] for p in capt["players"]),
+            sum(p["kills"] for p in capt["players"]),
+        ]
+        bisect.insort(self._timeline, (ts, capt["id"]))
+        self.daily.add_capt(capt, ts, count_players)
+        for player in capt["players"]:
+            self._index_player(capt, player)
+        self._count_opponent(capt, 1, *self._summaries[capt["id"]][1:])
+
+    def _unindex_capt(self, capt: dict):
+        ts = self.capt_ts(capt)
+        del self._by_id[capt["id"]]
+        del self._dates[capt["id"]]
+        del self._summaries[capt["id"]]
+        self._timeline.pop(bisect.bisect_left(self._timeline, (ts, capt["id"])))
+        self.daily.remove_capt(capt, ts)
+        self._count_opponent(capt, -1, -sum(p["damage"] for p in capt["players"]), -sum(p["kills"] for p in capt["players"]))
+        for player in capt["players"]:
+            uid = str(player["user_id"])
+            games = self._history[uid]
+            pos = bisect.bisect_left(games, (ts, capt["id"]))
+            games.pop(pos)
+            if not games:
+                del self._history[uid]
+                del self._form[uid]
+            elif pos >= len(games) - FORM_SIZE:
+                # Игра была в буфере формы - собираем его заново
+                self._rebuild_form(uid)
+
+    def _count_opponent(self, capt: dict, capts: int, damage: int, kills: int):
+        """Добавить к итогам против семьи капта: capts каптов (±1), урон и киллы"""
+        key = normalize_name(capt["vs"])
+        data = self._opponents.get(key)
+        if data is None:
+            data = self._opponents[key] = {"name": " ".join(capt["vs"].split()), "wins": 0, "losses": 0, "damage": 0, "kills": 0}
+            bisect.insort(self._opponent_keys, key)
+        if capts:
+            data["wins" if capt["win"] else "losses"] += capts
+        data["damage"] += damage
+        data["kills"] += kills
+        if data["wins"] + data["losses"] <= 0:
+            del self._opponents[key]
+            self._opponent_keys.pop(bisect.bisect_left(self._opponent_keys, key))
+
+    def opponent_stats(self, name: str):
+        """Итоги против семьи {"name", "wins", "losses", "damage", "kills"} или None"""
+        return self._opponents.get(normalize_name(name))
+
+    def opponents_by_prefix(self, prefix: str, limit: int = 25) -> list:
+        """Имена известных семей, начинающиеся с prefix (без учёта регистра и пробелов)"""
+        prefix = normalize_name(prefix)
+        names = []
+        for key in self._opponent_keys[bisect.bisect_left(self._opponent_keys, prefix):]:
+            if not key.startswith(prefix) or len(names) >= limit:
+                break
+            names.append(self._opponents[key]["name"])
+        return names
+
+    def _index_player(self, capt: dict, player: dict):
+        uid = str(player["user_id"])
+        games = self._history.setdefault(uid, [])
+        key = (self.capt_ts(capt), capt["id"])
+        pos = bisect.bisect_left(games, key)
+        games.insert(pos, key)
+        if pos == len(games) - 1:
+            self._form.setdefault(uid, FormBuffer()).push(player["damage"], player["kills"])
+        elif pos >= len(games) - FORM_SIZE:
+            # Капт задним числом внутри последних игр
+            self._rebuild_form(uid)
+
+    def _rebuild_form(self, uid: str):
+        form = self._form[uid] = FormBuffer()
+        for _, capt_id in self._history[uid][-FORM_SIZE:]:
+            capt = self._by_id[capt_id]
+            player = next(p for p in capt["players"] if str(p["user_id"]) == uid)
+            form.push(player["damage"], player["kills"])
+
+    def capt_date(self, capt: dict) -> datetime:
+        """Дата капта без повторного разбора строки"""
+        return self._dates[capt["id"]]
+
+    def capt_ts(self, capt: dict) -> float:
+        return self._dates[capt["id"]].timestamp()
+
+    def capt_summary(self, capt: dict):
+        """(игроков, урон, киллы) капта без подсчёта по строкам"""
+        return tuple(self._summaries[capt["id"]])
+
+    def capts_page(self, ts, start: int, count: int) -> list:
+        """Страница каптов от новых к старым: [(номер, капт)].
+
+        Номер - как в списке каптов: по возрастанию, последний капт имеет
+        наибольший номер (номер_капта команд при этом равен total - номер + 1).
+        ts=None - вся история в порядке добавления, иначе капты с момента
+        ts по дате.
+        """
+        if ts is None:
+            total = len(self.capts)
+            return [(total - i, self.capts[total - 1 - i]) for i in range(start, min(start + count, total))]
+        first = bisect.bisect_left(self._timeline, (ts,))
+        total = len(self._timeline) - first
+        return [
+            (total - i, self._by_id[self._timeline[-1 - i][1]])
+            for i in range(start, min(start + count, total))
+        ]
+
+    def capts_results(self, ts=None):
+        """(каптов, побед) с момента ts (None - за всё время)"""
+        return self.daily.results_since(ts)
+
+    def _count_player(self, player: dict, sign: int):
+        uid = str(player["user_id"])
+        if uid not in self.stats:
+            if sign < 0:
+                return
+            self.stats[uid] = {"damage": 0, "kills": 0, "games": 0}
+        self.stats[uid]["damage"] += sign * player["damage"]
+        self.stats[uid]["kills"] += sign * player["kills"]
+        self.stats[uid]["games"] += sign
+        if self.stats[uid]["games"] <= 0:
+            del self.stats[uid]
+
+    def get_capt(self, number: int):
+        """Капт по номеру (1 = последний) или None"""
+        if number < 1 or number > len(self.capts):
+            return None
+        return self.capts[-number]
+
+    def capt_list_number(self, capt: dict) -> int:
+        """Номер капта, как в /список_каптов (1 = первый); капты идут по возрастанию id"""
+        return bisect.bisect_left(self.capts, capt["id"], key=lambda c: c["id"]) + 1
+
+    def damage_quantiles(self, ts: float = None, user_id: int = None):
+        """(медиана, p90) урона с момента ts: игрока или всего клана; None - нет игр"""
+        if user_id is None:
+            sketch = self.daily.clan_sketch_since(ts)
         else:
-            await interaction.response.defer()
+            sketch = self.daily.user_sketch_since(str(user_id), ts)
+        if sketch is None or not sketch.size:
+            return None
+        return sketch.quantile(0.5), sketch.quantile(0.9)
+
+    def quantile_top(self, ranking: PeriodRanking, q: float, k: int) -> list:
+        """Топ-k по квантилю q урона за период рейтинга (3+ игры): [(user_id, значение, игр)]"""
+        rows = []
+        for uid, sketch in self.daily.sketches_since(ranking.ts).items():
+            data = ranking.stats.get(uid)
+            if data and data["games"] >= 3:
+                rows.append((uid, sketch.quantile(q), data["games"]))
+        return heapq.nsmallest(k, rows, key=lambda row: (-row[1], row[0]))
+
+    def player_form(self, user_id: int, n: int):
+        """(игр, урон, киллы) за последние n игр игрока или None"""
+        form = self._form.get(str(user_id))
+        return form.last(n) if form else None
+
+    def form_top(self, n: int, k: int) -> list:
+        """Топ-k по среднему урону за последние n игр (3+ игры): [(user_id, игр, урон, киллы)]"""
+        rows = []
+        for uid, form in self._form.items():
+            games, damage, kills = form.last(n)
+            if games >= 3:
+                rows.append((uid, games, damage, kills))
+        return heapq.nsmallest(k, rows, key=lambda row: (-row[2] / row[1], row[0]))
+
+    def player_games(self, user_id: int) -> int:
+        """Сколько каптов сыграл игрок"""
+        return len(self._history.get(str(user_id), ()))
+
+    def player_history(self, user_id: int, start: int, count: int) -> list:
+        """Страница каптов игрока от новых к старым: [(номер в списке каптов, капт, запись игрока)]"""
+        games = self._history.get(str(user_id), [])
+        page = []
+        for i in range(start, min(start + count, len(games))):
+            capt = self._by_id[games[-1 - i][1]]
+            player = next(p for p in capt["players"] if p["user_id"] == user_id)
+            page.append((self.capt_list_number(capt), capt, player))
+        return page
+
+    async def add_capt(self, capt: dict):
+        capt = dict(capt, id=self._next_id)
+        self._next_id += 1
+        await self._commit({"op": "add_capt", "capt": capt})
+
+    async def add_capts(self, capts: list):
+        """Добавить много каптов одним изменением (одна запись на диск)"""
+        batch = []
+        for capt in capts:
+            batch.append(dict(capt, id=self._next_id))
+            self._next_id += 1
+        if batch:
+            await self._commit({"op": "add_capts", "capts": batch})
+
+    async def add_player(self, capt: dict, player: dict) -> bool:
+        """Добавить игрока; False - капт удалён или игрок уже в нём"""
+        return await self._commit({"op": "add_player", "capt_id": capt["id"], "player": player})
+
+    async def add_players(self, capt: dict, players: list, all_or_nothing: bool = False) -> list:
+        """Добавить пачку игроков одним изменением; вернуть реально добавленных.
+
+        Уже состоящие в капте пропускаются (с all_or_nothing - не добавляется
+        никто); пустой список - ничего не добавлено или капт удалён.
+        """
+        change = {"op": "add_players", "capt_id": capt["id"], "players": players}
+        if all_or_nothing:
+            change["all"] = True
+        if not await self._commit(change):
+            return []
+        return change["players"]
+
+    async def delete_capt(self, number: int) -> dict:
+        removed = self.get_capt(number)
+        await self._commit({"op": "delete_capt", "capt_id": removed["id"]})
+        return removed
+
+    async def reset(self):
+        """Удалить всё, вернуть (кол-во каптов, кол-во записей)"""
+        counts = (len(self.capts), len(self.stats))
+        await self._commit({"op": "reset"})
+        return counts
+
+    async def remove_player_stats(self, user_id: int) -> bool:
+        uid = str(user_id)
+        if uid not in self.stats:
+            return False
+        return await self._commit({"op": "remove_stats", "user_id": uid})
+
+    async def export(self, kind: str, fmt: str, ts: float = None):
+        """Сжатая выгрузка за период с момента ts (см. write_export).
+
+        Список каптов копируется как ссылки, а сама запись идёт в отдельном
+        потоке: поток хранилища один, и долгая выгрузка задержала бы запись изменений.
+        """
+        capts = list(self.capts) if ts is None else self.capts_since(ts)
+        stats = {uid: dict(data) for uid, data in self.daily.since(ts).items()} if kind == "stats" else {}
+        return await asyncio.to_thread(write_export, kind, fmt, capts, stats)
+
+    def capts_since(self, ts: float) -> list:
+        """Капты с момента ts по возрастанию даты (бинарный поиск по индексу)"""
+        start = bisect.bisect_left(self._timeline, (ts,))
+        return [self._by_id[cid] for _, cid in self._timeline[start:]]
+
+store = Store(SqliteBackend(DB_SQLITE) if STORAGE_BACKEND == "sqlite" else JsonBackend(DB_JOURNAL))
+
+# ==================== КЭШ ИМЁН ====================
+class MemberNameCache:
+    """Отображаемые имена участников с TTL и вытеснением самых старых (LRU)"""
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._names = OrderedDict()  # user_id -> (имя, время истечения)
+        self.version = 0  # растёт при появлении, смене или удалении имени
+
+    def put(self, user_id: int, name: str):
+        old = self._names.get(user_id)
+        if old is None or old[0] != name:
+            self.version += 1
+        self._names[user_id] = (name, time.monotonic() + self.ttl)
+        self._names.move_to_end(user_id)
+        while len(self._names) > self.max_size:
+            self._names.popitem(last=False)
+
+    def get(self, user_id: int):
+        entry = self._names.get(user_id)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            del self._names[user_id]
+            return None
+        self._names.move_to_end(user_id)
+        return entry[0]
+
+    def discard(self, user_id: int):
+        if self._names.pop(user_id, None) is not None:
+            self.version += 1
+
+    async def resolve(self, guild: discord.Guild, user_id: int):
+        """Имя участника: кэш → кэш шлюза → REST. None, если его нет на сервере"""
+        name = self.get(user_id)
+        if name is not None:
+            return name
+
+        member = guild.get_member(user_id)
+        if member is None:
+            try:
+                member = await guild.fetch_member(user_id)
+            except discord.HTTPException:
+                return None
+
+        self.put(user_id, member.display_name)
+        return member.display_name
+
+    async def resolve_many(self, guild: discord.Guild, user_ids) -> dict:
+        """Имена сразу для многих участников: {user_id: имя}, отсутствующих на сервере нет.
+
+        Промахи кэша запрашиваются через шлюз пачками по MEMBER_QUERY_BATCH,
+        а если это не удалось - параллельными REST-запросами.
+        """
+        names = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            name = self.get(user_id)
+            if name is None:
+                member = guild.get_member(user_id)
+                if member is not None:
+                    name = member.display_name
+                    self.put(user_id, name)
+            if name is None:
+                missing.append(user_id)
+            else:
+                names[user_id] = name
 
-    @discord.ui.button(label="🔄", style=discord.ButtonStyle.success, custom_id="capts_refresh")
-    async def refresh(self, interaction: discord.Interaction, button: Button):
-        self.update_data()
-        await self.update_message(interaction)
-
-    async def update_message(self, interaction: discord.Interaction):
-        embed = await self.create_embed()
-        for child in self.children:
-            if isinstance(child, Button):
-                if child.custom_id == "capts_page":
-                    child.label = f"{self.current_page + 1}/{self.total_pages}"
-                elif child.custom_id == "capts_prev":
-                    child.disabled = self.current_page == 0
-                elif child.custom_id == "capts_next":
-                    child.disabled = self.current_page >= self.total_pages - 1
+        for i in range(0, len(missing), MEMBER_QUERY_BATCH):
+            batch = missing[i:i + MEMBER_QUERY_BATCH]
+            try:
+                members = await guild.query_members(user_ids=batch, limit=len(batch), cache=True)
+            except (asyncio.TimeoutError, discord.ClientException):
+                members = await self._fetch_many(guild, batch)
+            for member in members:
+                self.put(member.id, member.display_name)
+                names[member.id] = member.display_name
+
+        return names
+
+    async def _fetch_many(self, guild: discord.Guild, user_ids: list) -> list:
+        semaphore = asyncio.Semaphore(MEMBER_FETCH_CONCURRENCY)
+
+        async def fetch(user_id):
+            async with semaphore:
+                try:
+                    return await guild.fetch_member(user_id)
+                except discord.HTTPException:
+                    return None
+
+        members = await asyncio.gather(*(fetch(user_id) for user_id in user_ids))
+        return [m for m in members if m is not None]
+
+member_names = MemberNameCache(MEMBER_CACHE_TTL, MEMBER_CACHE_SIZE)
+
+class RosterIndex:
+    """Участники сервера, отсортированные по имени, для автодополнения.
+
+    Заполняется из кэша участников шлюза и событий об участниках, поэтому
+    поиск не обращается ни к диску, ни к REST.
+    """
+
+    def __init__(self):
+        self._keys = []   # (нормализованное имя, user_id) по возрастанию
+        self._names = {}  # user_id -> (ключ, отображаемое имя)
+
+    def set(self, user_id: int, name: str):
+        self.remove(user_id)
+        key = (normalize_name(name), user_id)
+        bisect.insort(self._keys, key)
+        self._names[user_id] = (key, name)
+
+    def remove(self, user_id: int):
+        entry = self._names.pop(user_id, None)
+        if entry is not None:
+            self._keys.pop(bisect.bisect_left(self._keys, entry[0]))
+
+    def search(self, prefix: str, limit: int = 25) -> list:
+        """[(user_id, имя)] участников, чьё имя начинается с prefix"""
+        prefix = normalize_name(prefix)
+        found = []
+        for name, user_id in self._keys[bisect.bisect_left(self._keys, (prefix,)):]:
+            if not name.startswith(prefix) or len(found) >= limit:
+                break
+            found.append((user_id, self._names[user_id][1]))
+        return found
+
+roster = RosterIndex()
+
+# ==================== КЭШ ОТРИСОВКИ ====================
+class RenderCache:
+    """Готовые embed'ы команд просмотра с вытеснением самых старых (LRU).
+
+    Записи действительны, пока не изменились данные хранилища и имена
+    участников: при смене их версий кэш очищается целиком.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._embeds = OrderedDict()  # (команда, период, страница, ...) -> embed.to_dict()
+        self._versions = None
+
+    def versions(self) -> tuple:
+        """Текущие версии данных и имён; берутся до отрисовки и передаются в put"""
+        return store.version, member_names.version
+
+    def _check_versions(self):
+        versions = self.versions()
+        if versions != self._versions:
+            self._embeds.clear()
+            self._versions = versions
+
+    def get(self, key: tuple):
+        """Копия сохранённого embed с текущим временем или None"""
+        self._check_versions()
+        data = self._embeds.get(key)
+        if data is None:
+            return None
+        self._embeds.move_to_end(key)
+        embed = discord.Embed.from_dict(data)
+        embed.timestamp = now()
+        return embed
+
+    def put(self, key: tuple, embed: discord.Embed, versions: tuple):
+        # Пока embed собирался, данные или имена могли измениться - он уже устарел
+        if versions != self.versions():
+            return
+        self._check_versions()
+        self._embeds[key] = embed.to_dict()
+        self._embeds.move_to_end(key)
+        while len(self._embeds) > self.max_size:
+            self._embeds.popitem(last=False)
+
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+
+# ==================== VIEW ДЛЯ СПИСКА КАПТОВ ====================
+class CaptsPageButton(discord.ui.DynamicItem[Button], template=r"capts:(?P<action>prev|page|next|refresh):(?P<period>all|week|month):(?P<page>\d+)"):
+    """Кнопка списка каптов: период и страница хранятся в custom_id.
+
+    Класс регистрируется один раз при старте, поэтому кнопки работают на
+    любых сообщениях со списком, в том числе после перезапуска бота.
+    """
+
+    def __init__(self, action: str, period: str, page: int, **kwargs):
+        super().__init__(Button(custom_id=f"capts:{action}:{period}:{page}", **kwargs))
+        self.action = action
+        self.period = period
+        self.page = page
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: Button, match):
+        return cls(match["action"], match["period"], int(match["page"]))
+
+    async def callback(self, interaction: discord.Interaction):
+        if self.action == "page":
+            return await interaction.response.defer()
+
+        page = self.page + {"prev": -1, "next": 1}.get(self.action, 0)
+        view = CaptsListView(self.period, page)
+        embed = await view.create_embed()
 
         try:
-            await interaction.response.edit_message(embed=embed, view=self)
+            await interaction.response.edit_message(embed=embed, view=view)
         except:
             try:
-                await interaction.message.edit(embed=embed, view=self)
+                await interaction.message.edit(embed=embed, view=view)
             except:
                 pass
 
+class CaptsListView(View):
+    """Страница списка каптов; данные читаются из хранилища при отрисовке"""
+
+    def __init__(self, period: str = "all", page: int = 0):
+        super().__init__(timeout=None)
+        self.period = period
+        self.capts_per_page = 10
+        self.update_data()
+        self.current_page = max(0, min(page, self.total_pages - 1))
+
+        page = self.current_page
+        self.add_item(CaptsPageButton(
+            "prev", period, page, label="⬅️", style=discord.ButtonStyle.secondary, disabled=page == 0
+        ))
+        self.add_item(CaptsPageButton(
+            "page", period, page, label=f"{page + 1}/{self.total_pages}", style=discord.ButtonStyle.primary
+        ))
+        self.add_item(CaptsPageButton(
+            "next", period, page, label="➡️", style=discord.ButtonStyle.secondary,
+            disabled=page >= self.total_pages - 1
+        ))
+        self.add_item(CaptsPageButton(
+            "refresh", period, page, label="🔄", style=discord.ButtonStyle.success
+        ))
+
+    def update_data(self):
+        # Вид хранит только границу периода и итоги, капты берутся из хранилища постранично
+        days = {"week": 7, "month": 30}.get(self.period)
+        self.since = None if days is None else (now() - timedelta(days=days)).timestamp()
+        self.total, self.wins = store.capts_results(self.since)
+        
+        self.total_pages = max(1, (self.total + self.capts_per_page - 1) // self.capts_per_page)
+
     async def create_embed(self):
+        # При тех же версиях данных число каптов в периоде однозначно задаёт страницу
+        key = ("список_каптов", self.period, self.current_page, self.total)
+        embed = render_cache.get(key)
+        if embed is None:
+            versions = render_cache.versions()
+            embed = self.render_embed()
+            render_cache.put(key, embed, versions)
+        return embed
+
+    def render_embed(self):
         period_text = {
             "week": "📅 за неделю",
             "month": "📅 за месяц",
@@ -186,30 +1571,24 @@ class CaptsListView(View):
             timestamp=now()
         )
 
-        if not self.capts:
+        if not self.total:
             embed.description = "📭 Нет каптов за этот период"
         else:
-            reversed_capts = list(reversed(self.capts))
             start = self.current_page * self.capts_per_page
-            end = min(start + self.capts_per_page, len(reversed_capts))
 
             desc = ""
-            for i in range(start, end):
-                capt = reversed_capts[i]
-                num = len(self.capts) - i
-                date = datetime.fromisoformat(capt["date"]).strftime("%d.%m.%Y %H:%M")
+            for num, capt in store.capts_page(self.since, start, self.capts_per_page):
+                date = store.capt_date(capt).strftime("%d.%m.%Y %H:%M")
                 result = "✅" if capt["win"] else "❌"
-                players = len(capt["players"])
-                damage = sum(p["damage"] for p in capt["players"])
-                kills = sum(p["kills"] for p in capt["players"])
+                players, damage, kills = store.capt_summary(capt)
 
                 desc += f"**#{num}. Семья vs {capt['vs']}** {result}\n"
                 desc += f"🕐 {date} │ 👥 {players} │ 💥 {damage:,} │ ☠️ {kills}\n\n"
 
             embed.description = desc
 
-            wins = sum(1 for c in self.capts if c["win"])
-            total = len(self.capts)
+            wins = self.wins
+            total = self.total
             winrate = (wins/total*100) if total > 0 else 0
 
             embed.add_field(
@@ -221,7 +1600,294 @@ class CaptsListView(View):
         embed.set_footer(text=f"Страница {self.current_page+1}/{self.total_pages}")
         return embed
 
+# ==================== VIEW ДЛЯ ИСТОРИИ ИГРОКА ====================
+class HistoryPageButton(discord.ui.DynamicItem[Button], template=r"history:(?P<action>prev|page|next):(?P<user>\d+):(?P<page>\d+)"):
+    """Кнопка истории игрока: игрок и страница хранятся в custom_id"""
+
+    def __init__(self, action: str, user_id: int, page: int, **kwargs):
+        super().__init__(Button(custom_id=f"history:{action}:{user_id}:{page}", **kwargs))
+        self.action = action
+        self.user_id = user_id
+        self.page = page
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: Button, match):
+        return cls(match["action"], int(match["user"]), int(match["page"]))
+
+    async def callback(self, interaction: discord.Interaction):
+        if self.action == "page":
+            return await interaction.response.defer()
+
+        page = self.page + {"prev": -1, "next": 1}[self.action]
+        view = PlayerHistoryView(self.user_id, page)
+        embed = await view.create_embed(interaction.guild)
+
+        try:
+            await interaction.response.edit_message(embed=embed, view=view)
+        except:
+            pass
+
+class PlayerHistoryView(View):
+    """Страница каптов одного игрока по индексу игрок -> капты"""
+
+    def __init__(self, user_id: int, page: int = 0):
+        super().__init__(timeout=None)
+        self.user_id = user_id
+        self.per_page = 10
+        self.total = store.player_games(user_id)
+        self.total_pages = max(1, (self.total + self.per_page - 1) // self.per_page)
+        self.current_page = max(0, min(page, self.total_pages - 1))
+
+        page = self.current_page
+        self.add_item(HistoryPageButton(
+            "prev", user_id, page, label="⬅️", style=discord.ButtonStyle.secondary, disabled=page == 0
+        ))
+        self.add_item(HistoryPageButton(
+            "page", user_id, page, label=f"{page + 1}/{self.total_pages}", style=discord.ButtonStyle.primary
+        ))
+        self.add_item(HistoryPageButton(
+            "next", user_id, page, label="➡️", style=discord.ButtonStyle.secondary,
+            disabled=page >= self.total_pages - 1
+        ))
+
+    async def create_embed(self, guild: discord.Guild):
+        games = store.player_history(self.user_id, self.current_page * self.per_page, self.per_page)
+        name = await member_names.resolve(guild, self.user_id)
+        if name is None:
+            name = games[0][2]["user_name"] if games else f"Игрок {self.user_id}"
+
+        embed = discord.Embed(
+            title=f"📜 История игрока {name}",
+            color=0x3498db,
+            timestamp=now()
+        )
+
+        if not games:
+            embed.description = "📭 Игрок не участвовал в каптах"
+        else:
+            desc = ""
+            for num, capt, player in games:
+                date = store.capt_date(capt).strftime("%d.%m.%Y %H:%M")
+                result = "✅" if capt["win"] else "❌"
+                desc += f"**#{num}. Семья vs {capt['vs']}** {result}\n"
+                desc += f"🕐 {date} │ 💥 {player['damage']:,} │ ☠️ {player['kills']}\n\n"
+            embed.description = desc
+
+        embed.set_footer(text=f"Игр: {self.total} • Страница {self.current_page+1}/{self.total_pages}")
+        return embed
+
+# ==================== ИМПОРТ КАПТОВ ====================
+CAPT_DATE_RE = re.compile(r'(\d{2}\.\d{2}\.\d{4} \d{2}:\d{2})')
+WIN_WORDS = ["win", "w", "1", "true", "победа", "в"]
+
+class CaptFileParser:
+    """Построчный разбор файла каптов.
+
+    Строки подаются по мере чтения через feed(); готовые капты копятся
+    в capts (имена игроков - None, подставляются после разбора).
+    """
+
+    def __init__(self, result: str):
+        self.result = result
+        self.capts = []
+        self.errors = []
+        self.lines = 0
+        self.players = []
+        self.seen = set()
+        self.family = ""
+        self.date = None
+        self.header_line = 0
+        self.current_result = result
+
+    def save_current(self):
+        if not self.players:
+            return
+        if self.date is None:
+            # Дату не угадываем: капт из старой выгрузки попал бы в текущую неделю
+            self.errors.append(f"❌ Строка {self.header_line}: В заголовке нет даты (ДД.ММ.ГГГГ ЧЧ:ММ), капт пропущен")
+            return
+        self.capts.append({
+            "vs": self.family if self.family else "Противник",
+            "date": self.date.isoformat(),
+            "win": self.current_result.lower() in WIN_WORDS,
+            "players": self.players
+        })
+
+    def feed(self, line: str):
+        self.lines += 1
+        line_num = self.lines
+        line = line.strip()
+        if not line:
+            return
+        
+        lower = line.lower()
+        if lower.startswith("семья"):
+            # Заголовок нового капта: сохраняем предыдущий
+            self.save_current()
+            self.players = []
+            self.seen = set()
+            self.family = ""
+            self.date = None
+            self.header_line = line_num
+            self.current_result = self.result
+            
+            try:
+                header = line[6:].strip()  # "Семья " - 6 символов
+                date_match = CAPT_DATE_RE.search(header)
+                if date_match:
+                    self.date = datetime.strptime(date_match.group(1), "%d.%m.%Y %H:%M")
+                    self.family = CAPT_DATE_RE.sub('', header).strip()
+                else:
+                    self.family = header
+                
+                if "win" in lower or "победа" in lower:
+                    self.current_result = "win"
+                elif "lose" in lower or "поражение" in lower:
+                    self.current_result = "lose"
+            except Exception as e:
+                self.errors.append(f"❌ Строка {line_num}: Ошибка парсинга заголовка - {str(e)}")
+                self.family = "Противник"
+        
+        elif self.family or self.players:
+            parts = line.split()
+            if len(parts) < 3:
+                self.errors.append(f"❌ Строка {line_num}: Неверный формат данных игрока")
+                return
+            try:
+                user_id = int(parts[0])
+                damage = int(parts[1])
+                kills = int(parts[2])
+            except Exception as e:
+                self.errors.append(f"❌ Строка {line_num}: Ошибка обработки игрока - {str(e)}")
+                return
+            
+            if user_id in self.seen:
+                self.errors.append(f"⚠️ Строка {line_num}: Игрок {user_id} уже в капте")
+                return
+            self.seen.add(user_id)
+            self.players.append({
+                "user_id": user_id,
+                "user_name": None,
+                "damage": damage,
+                "kills": kills
+            })
+
+    def finish(self):
+        """Сохранить последний капт"""
+        self.save_current()
+        self.players = []
+        self.seen = set()
+
+def parse_chunk(parser: CaptFileParser, lines: list, final: bool = False):
+    """Разобрать пачку строк (в пуле процессов): (парсер, капты, ошибки).
+
+    Готовые капты и ошибки забираются из парсера, чтобы между процессами
+    передавалось только состояние текущего капта.
+    """
+    for line in lines:
+        parser.feed(line)
+    if final:
+        parser.finish()
+    capts, parser.capts = parser.capts, []
+    errors, parser.errors = parser.errors, []
+    return parser, capts, errors
+
+async def read_lines(attachment: discord.Attachment):
+    """Строки вложения по мере скачивания, без чтения файла целиком"""
+    async with aiohttp.ClientSession() as session:
+        async with session.get(attachment.url) as resp:
+            resp.raise_for_status()
+            async for raw in resp.content:
+                yield raw.decode('utf-8')
+
+# ==================== ЭКСПОРТ ====================
+EXPORT_COLUMNS = {
+    "capts": ["id", "date", "vs", "win", "players", "damage", "kills"],
+    "players": ["capt_id", "date", "vs", "win", "user_id", "user_name", "damage", "kills"],
+    "stats": ["user_id", "games", "damage", "kills", "avg_damage"],
+}
+
+def export_rows(kind: str, capts: list, stats: dict):
+    """Строки выгрузки по одной, без сборки всей таблицы в памяти"""
+    if kind == "stats":
+        for uid, data in stats.items():
+            yield {"user_id": uid, "games": data["games"], "damage": data["damage"],
+                   "kills": data["kills"], "avg_damage": data["damage"] // data["games"]}
+        return
+    for capt in capts:
+        players = list(capt["players"])
+        if kind == "capts":
+            yield {"id": capt["id"], "date": capt["date"], "vs": capt["vs"], "win": capt["win"],
+                   "players": len(players), "damage": sum(p["damage"] for p in players),
+                   "kills": sum(p["kills"] for p in players)}
+            continue
+        for player in players:
+            yield {"capt_id": capt["id"], "date": capt["date"], "vs": capt["vs"], "win": capt["win"],
+                   "user_id": player["user_id"], "user_name": player["user_name"],
+                   "damage": player["damage"], "kills": player["kills"]}
+
+def write_export(kind: str, fmt: str, capts: list, stats: dict):
+    """Записать выгрузку (CSV или JSON Lines) со сжатием gzip во временный файл.
+
+    Строки пишутся пачками по EXPORT_CHUNK_ROWS; файл остаётся в памяти,
+    пока не превысит EXPORT_SPOOL_SIZE. Возвращает файл, открытый с начала.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    with gzip.GzipFile(fileobj=spool, mode="wb") as gz:
+        text = io.TextIOWrapper(gz, encoding="utf-8", newline="")
+        writer = None
+        if fmt == "csv":
+            writer = csv.DictWriter(text, EXPORT_COLUMNS[kind])
+            writer.writeheader()
+
+        def write(chunk):
+            if writer is not None:
+                writer.writerows(chunk)
+            else:
+                text.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in chunk))
+
+        chunk = []
+        for row in export_rows(kind, capts, stats):
+            chunk.append(row)
+            if len(chunk) >= EXPORT_CHUNK_ROWS:
+                write(chunk)
+                chunk = []
+        write(chunk)
+        text.flush()
+        text.detach()
+    spool.seek(0)
+    return spool
+
 # ==================== КОМАНДЫ ====================
+async def capt_autocomplete(inter: discord.Interaction, current: str):
+    """Последние капты: по номеру, противнику или дате.
+
+    Подпись - номер из списка каптов, значение - номер_капта (1 = последний).
+    """
+    query = normalize_name(current)
+    total = len(store.capts)
+    choices = []
+    for num, capt in store.capts_page(None, 0, AUTOCOMPLETE_RECENT_CAPTS):
+        number = total - num + 1
+        date = store.capt_date(capt).strftime("%d.%m.%Y")
+        vs = " ".join(capt["vs"].split())
+        if query and not (
+            str(num).startswith(query) or str(number).startswith(query)
+            or vs.casefold().startswith(query) or date.startswith(query)
+        ):
+            continue
+        choices.append(app_commands.Choice(name=f"#{num} · vs {vs} · {date}"[:100], value=number))
+        if len(choices) == 25:
+            break
+    return choices
+
+async def player_autocomplete(inter: discord.Interaction, current: str):
+    """Участники сервера по началу имени; значение - ID"""
+    return [
+        app_commands.Choice(name=name[:100], value=str(user_id))
+        for user_id, name in roster.search(current)
+    ]
+
 @tree.command(name="добавить_капт", description="📝 Добавить новый капт", guild=discord.Object(GUILD_ID))
 @app_commands.describe(
     против="Против кого играли",
@@ -255,11 +1921,9 @@ async def add_capt(inter: discord.Interaction, против: str, результ
         "players": []
     }
     
-    capts = load_capts()
-    capts.append(new_capt)
-    save_capts(capts)
+    await store.add_capt(new_capt)
     
-    asyncio.create_task(update_capts_list())
+    leaderboards.request("capts")
     
     await log_action(
         inter.guild, inter.user,
@@ -280,6 +1944,7 @@ async def add_capt(inter: discord.Interaction, против: str, результ
     киллы="Киллы",
     номер_капта="Номер капта (1 = последний)"
 )
+@app_commands.autocomplete(игрок=player_autocomplete, номер_капта=capt_autocomplete)
 async def add_player(inter: discord.Interaction, игрок: str, урон: int, киллы: int, номер_капта: int = 1):
     if not has_role(inter.user, ADMIN_ROLES):
         return await inter.response.send_message("❌ Нет доступа", ephemeral=True)
@@ -295,51 +1960,39 @@ async def add_player(inter: discord.Interaction, игрок: str, урон: int,
         except:
             return await inter.response.send_message("❌ Используйте @упоминание или ID", ephemeral=True)
 
-    try:
-        member = await inter.guild.fetch_member(user_id)
-    except:
+    name = await member_names.resolve(inter.guild, user_id)
+    if name is None:
         return await inter.response.send_message("❌ Игрок не найден", ephemeral=True)
 
-    capts = load_capts()
-    if номер_капта < 1 or номер_капта > len(capts):
+    capt = store.get_capt(номер_капта)
+    if capt is None:
         return await inter.response.send_message("❌ Капт не найден", ephemeral=True)
-
-    capt = capts[-номер_капта]
     
     if any(p["user_id"] == user_id for p in capt["players"]):
-        return await inter.response.send_message(f"❌ **{member.display_name}** уже в капте", ephemeral=True)
+        return await inter.response.send_message(f"❌ **{name}** уже в капте", ephemeral=True)
 
-    capt["players"].append({
+    added = await store.add_player(capt, {
         "user_id": user_id,
-        "user_name": member.display_name,
+        "user_name": name,
         "damage": урон,
         "kills": киллы
     })
-
-    st = load_stats()
-    uid = str(user_id)
-    if uid not in st:
-        st[uid] = {"damage": 0, "kills": 0, "games": 0}
-    
-    st[uid]["damage"] += урон
-    st[uid]["kills"] += киллы
-    st[uid]["games"] += 1
+    if not added:
+        # Пока ждали запись, капт могли удалить или добавить игрока другой командой
+        if capt["id"] not in store._by_id:
+            return await inter.response.send_message("❌ Капт не найден", ephemeral=True)
+        return await inter.response.send_message(f"❌ **{name}** уже в капте", ephemeral=True)
     
-    save_stats(st)
-    save_capts(capts)
-    
-    asyncio.create_task(update_capts_list())
-    asyncio.create_task(update_avg_top())
-    asyncio.create_task(update_kills_top())
+    leaderboards.request()
     
     await log_action(
         inter.guild, inter.user,
         "👤 Игрок добавлен",
-        f"Капт #{len(capts) - номер_капта + 1}\nИгрок: {member.mention}\nУрон: {урон:,}\nКиллы: {киллы}"
+        f"Капт #{store.capt_list_number(capt)}\nИгрок: <@{user_id}>\nУрон: {урон:,}\nКиллы: {киллы}"
     )
     
     await inter.response.send_message(
-        f"✅ **{member.display_name}** добавлен\n"
+        f"✅ **{name}** добавлен\n"
         f"💥 Урон: **{урон:,}** │ ☠️ Киллы: **{киллы}**",
         ephemeral=True
     )
@@ -347,9 +2000,11 @@ async def add_player(inter: discord.Interaction, игрок: str, урон: int,
 @tree.command(name="загрузить_игроков", description="📤 Загрузить игроков из текста", guild=discord.Object(GUILD_ID))
 @app_commands.describe(
     данные="ID урон киллы (каждый с новой строки)",
-    номер_капта="Номер капта"
+    номер_капта="Номер капта",
+    все_или_ничего="Не добавлять никого, если в данных есть ошибки"
 )
-async def upload_players(inter: discord.Interaction, данные: str, номер_капта: int = 1):
+@app_commands.autocomplete(номер_капта=capt_autocomplete)
+async def upload_players(inter: discord.Interaction, данные: str, номер_капта: int = 1, все_или_ничего: bool = False):
     if not has_role(inter.user, ADMIN_ROLES):
         return await inter.response.send_message("❌ Нет доступа", ephemeral=True)
     
@@ -360,20 +2015,18 @@ async def upload_players(inter: discord.Interaction, данные: str, номе
         defer_used = False
     
     try:
-        capts = load_capts()
-        if номер_капта < 1 or номер_капта > len(capts):
+        capt = store.get_capt(номер_капта)
+        if capt is None:
             if defer_used:
                 await inter.followup.send("❌ Капт не найден", ephemeral=True)
             else:
                 await inter.response.send_message("❌ Капт не найден", ephemeral=True)
             return
         
-        capt = capts[-номер_капта]
-        lines = данные.strip().split('\n')
-        added = 0
+        # 1. Разбираем все строки
+        rows = []
         errors = []
-        
-        for line in lines:
+        for line in данные.strip().split('\n'):
             line = line.strip()
             if not line:
                 continue
@@ -391,47 +2044,61 @@ async def upload_players(inter: discord.Interaction, данные: str, номе
                 errors.append(f"❌ Ошибка парсинга: {line}")
                 continue
             
-            try:
-                member = await inter.guild.fetch_member(user_id)
-            except:
+            rows.append((user_id, damage, kills))
+        
+        # 2. Ищем всех игроков на сервере одним запросом
+        names = await member_names.resolve_many(inter.guild, [row[0] for row in rows])
+        
+        # 3. Отсеиваем отсутствующих и повторы (в капте и внутри данных)
+        seen = {p["user_id"] for p in capt["players"]}
+        players = []
+        for user_id, damage, kills in rows:
+            name = names.get(user_id)
+            if name is None:
                 errors.append(f"❌ Игрок {user_id} не найден")
                 continue
-            
-            if any(p["user_id"] == user_id for p in capt["players"]):
-                errors.append(f"⚠️ {member.display_name} уже добавлен")
+            if user_id in seen:
+                errors.append(f"⚠️ {name} уже добавлен")
                 continue
-            
-            capt["players"].append({
+            seen.add(user_id)
+            players.append({
                 "user_id": user_id,
-                "user_name": member.display_name,
+                "user_name": name,
                 "damage": damage,
                 "kills": kills
             })
-            
-            st = load_stats()
-            uid = str(user_id)
-            if uid not in st:
-                st[uid] = {"damage": 0, "kills": 0, "games": 0}
-            st[uid]["damage"] += damage
-            st[uid]["kills"] += kills
-            st[uid]["games"] += 1
-            save_stats(st)
-            
-            added += 1
         
-        save_capts(capts)
+        if errors and все_или_ничего:
+            players = []
+        
+        # 4. Всё добавляется одним изменением
+        added_players = await store.add_players(capt, players, все_или_ничего) if players else []
+        if players and not added_players and capt["id"] not in store._by_id:
+            if defer_used:
+                await inter.followup.send("❌ Капт не найден", ephemeral=True)
+            else:
+                await inter.response.send_message("❌ Капт не найден", ephemeral=True)
+            return
+        # Пока ждали запись, часть игроков могла добавить другая команда
+        added_ids = {p["user_id"] for p in added_players}
+        present = {p["user_id"] for p in capt["players"]}
+        for player in players:
+            if player["user_id"] not in added_ids and player["user_id"] in present:
+                errors.append(f"⚠️ {player['user_name']} уже добавлен")
+        added = len(added_players)
         
-        asyncio.create_task(update_capts_list())
-        asyncio.create_task(update_avg_top())
-        asyncio.create_task(update_kills_top())
+        if added:
+            leaderboards.request()
         
         await log_action(
             inter.guild, inter.user,
             "📤 Массовое добавление",
-            f"Капт #{len(capts) - номер_капта + 1}\nДобавлено: {added} игроков"
+            f"Капт #{store.capt_list_number(capt)}\nДобавлено: {added} игроков"
         )
         
         msg = f"✅ Добавлено игроков: **{added}**"
+        if errors and все_или_ничего:
+            msg = "❌ Никто не добавлен: в данных есть ошибки"
         if errors:
             msg += f"\n\n⚠️ Ошибки:\n" + "\n".join(errors[:5])
             if len(errors) > 5:
@@ -474,146 +2141,43 @@ async def upload_capts(inter: discord.Interaction, файл: discord.Attachment,
                 await inter.response.send_message("❌ Файл должен быть .txt", ephemeral=True)
             return
         
-        content = await файл.read()
-        text = content.decode('utf-8')
-        
-        capts = load_capts()
-        st = load_stats()
-        lines = text.strip().split('\n')
-        
-        current_capt_players = []
-        current_capt_info = None
-        current_family_name = ""
-        current_date_time = None
-        current_result = результат
-        added_capts = 0
+        parser = CaptFileParser(результат)
+        new_capts = []
         errors = []
-        
-        def save_current_capt():
-            nonlocal added_capts, current_capt_players, current_family_name, current_date_time, current_result
-            
-            if current_capt_players:
-                try:
-                    # Используем дату из файла или текущую
-                    if current_date_time:
-                        dt = current_date_time
-                    
-                    new_capt = {
-                        "vs": current_family_name if current_family_name else "Противник",
-                        "date": dt.isoformat(),
-                        "win": current_result.lower() in ["win", "w", "1", "true", "победа", "в"],
-                        "players": current_capt_players.copy()
-                    }
-                    capts.append(new_capt)
-                    added_capts += 1
-                    
-                    # Обновляем статистику для всех игроков
-                    for player in current_capt_players:
-                        uid = str(player["user_id"])
-                        if uid not in st:
-                            st[uid] = {"damage": 0, "kills": 0, "games": 0}
-                        st[uid]["damage"] += player["damage"]
-                        st[uid]["kills"] += player["kills"]
-                        st[uid]["games"] += 1
-                        
-                except Exception as e:
-                    errors.append(f"❌ Ошибка сохранения капта - {str(e)}")
-        
-        for line_num, line in enumerate(lines, 1):
-            line = line.strip()
-            
-            if not line:
-                # Пустая строка - пропускаем
+        chunk = []
+        last_progress = time.monotonic()
+        async for line in read_lines(файл):
+            chunk.append(line)
+            if len(chunk) < UPLOAD_CHUNK_LINES:
                 continue
-            
-            # Проверяем, является ли строка заголовком капта (начинается с "Семья")
-            if line.lower().startswith("семья"):
-                # Сохраняем предыдущий капт (если есть)
-                save_current_capt()
-                
-                # Сбрасываем данные для нового капта
-                current_capt_players = []
-                current_family_name = ""
-                current_date_time = None
-                current_result = результат
-                
-                # Парсим заголовок
-                try:
-                    # Удаляем "Семья" из начала строки
-                    header = line[6:].strip()  # "Семья " - 6 символов
-                    
-                    # Ищем дату и время в формате DD.MM.YYYY HH:MM
-                    date_match = re.search(r'(\d{2}\.\d{2}\.\d{4} \d{2}:\d{2})', header)
-                    if date_match:
-                        date_time_str = date_match.group(1)
-                        # Извлекаем дату и время из заголовка
-                        header_without_date = re.sub(r'(\d{2}\.\d{2}\.\d{4} \d{2}:\d{2})', '', header).strip()
-                        
-                        # Парсим дату и время
-                        dt = datetime.strptime(date_time_str, "%d.%m.%Y %H:%M")
-                        current_date_time = dt
-                        
-                        # Всё что осталось - название семьи
-                        current_family_name = header_without_date
-                    else:
-                        # Даты нет, всё что после "Семья" - название
-                        current_family_name = header
-                    
-                    # Проверяем результат в заголовке
-                    if "win" in line.lower() or "победа" in line.lower():
-                        current_result = "win"
-                    elif "lose" in line.lower() or "поражение" in line.lower():
-                        current_result = "lose"
-                    
-                except Exception as e:
-                    errors.append(f"❌ Строка {line_num}: Ошибка парсинга заголовка - {str(e)}")
-                    current_family_name = "Противник"
-            
-            elif current_family_name or current_capt_players:
-                # Это строка с данными игрока
-                parts = line.split()
-                if len(parts) >= 3:
-                    try:
-                        user_id = int(parts[0])
-                        damage = int(parts[1])
-                        kills = int(parts[2])
-                        
-                        # Проверяем, есть ли уже такой игрок в текущем капте
-                        if any(p["user_id"] == user_id for p in current_capt_players):
-                            errors.append(f"⚠️ Строка {line_num}: Игрок {user_id} уже в капте")
-                            continue
-                        
-                        # Ищем игрока на сервере
-                        try:
-                            member = await inter.guild.fetch_member(user_id)
-                            user_name = member.display_name
-                        except:
-                            user_name = f"Игрок {user_id}"
-                        
-                        current_capt_players.append({
-                            "user_id": user_id,
-                            "user_name": user_name,
-                            "damage": damage,
-                            "kills": kills
-                        })
-                        
-                    except Exception as e:
-                        errors.append(f"❌ Строка {line_num}: Ошибка обработки игрока - {str(e)}")
-                else:
-                    errors.append(f"❌ Строка {line_num}: Неверный формат данных игрока")
+            parser, capts, chunk_errors = await run_cpu(parse_chunk, parser, chunk)
+            new_capts += capts
+            errors += chunk_errors
+            chunk = []
+            if defer_used and time.monotonic() - last_progress >= UPLOAD_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                await inter.edit_original_response(
+                    content=f"⏳ Обработано строк: {parser.lines}, каптов: {len(new_capts)}"
+                )
+        parser, capts, chunk_errors = await run_cpu(parse_chunk, parser, chunk, True)
+        new_capts += capts
+        errors += chunk_errors
+        added_capts = len(new_capts)
         
-        # Сохраняем последний капт
-        save_current_capt()
+        # Ищем всех игроков на сервере разом
+        names = await member_names.resolve_many(
+            inter.guild, [p["user_id"] for c in new_capts for p in c["players"]]
+        )
+        for new_capt in new_capts:
+            for player in new_capt["players"]:
+                player["user_name"] = names.get(player["user_id"]) or f"Игрок {player['user_id']}"
         
-        # Сохраняем изменения в файлы
+        # Все капты записываются одним изменением
         if added_capts > 0:
-            save_capts(capts)
-            save_stats(st)
+            await store.add_capts(new_capts)
             
             # Запускаем автообновление
-            asyncio.create_task(update_capts_list())
-            asyncio.create_task(update_avg_top())
-            asyncio.create_task(update_kills_top())
+            leaderboards.request()
             
             await log_action(
                 inter.guild, inter.user,
@@ -634,7 +2198,8 @@ async def upload_capts(inter: discord.Interaction, файл: discord.Attachment,
                     msg += f"\n... и ещё {len(errors) - 5} ошибок"
         
         if defer_used:
-            await inter.followup.send(msg, ephemeral=True)
+            # Итог заменяет сообщение о ходе загрузки
+            await inter.edit_original_response(content=msg)
         else:
             await inter.response.send_message(msg, ephemeral=True)
         
@@ -650,32 +2215,17 @@ async def upload_capts(inter: discord.Interaction, файл: discord.Attachment,
 
 @tree.command(name="удалить_капт", description="🗑️ Удалить капт", guild=discord.Object(GUILD_ID))
 @app_commands.describe(номер="Номер капта")
+@app_commands.autocomplete(номер=capt_autocomplete)
 async def delete_capt(inter: discord.Interaction, номер: int):
     if not has_role(inter.user, ADMIN_ROLES):
         return await inter.response.send_message("❌ Нет доступа", ephemeral=True)
     
-    capts = load_capts()
-    if номер < 1 or номер > len(capts):
+    if store.get_capt(номер) is None:
         return await inter.response.send_message("❌ Капт не найден", ephemeral=True)
     
-    removed_capt = capts.pop(-номер)
-    
-    st = load_stats()
-    for player in removed_capt["players"]:
-        uid = str(player["user_id"])
-        if uid in st:
-            st[uid]["damage"] -= player["damage"]
-            st[uid]["kills"] -= player["kills"]
-            st[uid]["games"] -= 1
-            if st[uid]["games"] <= 0:
-                del st[uid]
-    
-    save_stats(st)
-    save_capts(capts)
+    removed_capt = await store.delete_capt(номер)
     
-    asyncio.create_task(update_capts_list())
-    asyncio.create_task(update_avg_top())
-    asyncio.create_task(update_kills_top())
+    leaderboards.request()
     
     await log_action(
         inter.guild, inter.user,
@@ -693,29 +2243,85 @@ async def reset_stats(inter: discord.Interaction):
     if not has_role(inter.user, ADMIN_ROLES):
         return await inter.response.send_message("❌ Нет доступа", ephemeral=True)
     
-    capts = load_capts()
-    stats_count = len(load_stats())
-    
-    save_stats({})
-    save_capts([])
+    capts_count, stats_count = await store.reset()
     
-    asyncio.create_task(update_capts_list())
-    asyncio.create_task(update_avg_top())
-    asyncio.create_task(update_kills_top())
+    leaderboards.request()
     
     await log_action(
         inter.guild, inter.user,
         "🔄 Сброс статистики",
-        f"Удалено каптов: {len(capts)}\nУдалено записей: {stats_count}"
+        f"Удалено каптов: {capts_count}\nУдалено записей: {stats_count}"
     )
     
     await inter.response.send_message(
         f"✅ Статистика сброшена\n"
-        f"Удалено каптов: **{len(capts)}**\n"
+        f"Удалено каптов: **{capts_count}**\n"
         f"Удалено записей: **{stats_count}**",
         ephemeral=True
     )
 
+@tree.command(name="экспорт", description="📦 Выгрузить данные файлом", guild=discord.Object(GUILD_ID))
+@app_commands.describe(данные="Что выгрузить", формат="Формат файла", period="Период")
+@app_commands.choices(данные=[
+    app_commands.Choice(name="Капты", value="capts"),
+    app_commands.Choice(name="Игроки в каптах", value="players"),
+    app_commands.Choice(name="Итоги игроков", value="stats")
+], формат=[
+    app_commands.Choice(name="CSV", value="csv"),
+    app_commands.Choice(name="JSON Lines", value="jsonl")
+], period=[
+    app_commands.Choice(name="За всё время", value="all"),
+    app_commands.Choice(name="За неделю", value="week"),
+    app_commands.Choice(name="За месяц", value="month")
+])
+async def export_data(inter: discord.Interaction, данные: str = "capts", формат: str = "csv", period: str = "all"):
+    if not has_role(inter.user, ADMIN_ROLES):
+        return await inter.response.send_message("❌ Нет доступа", ephemeral=True)
+    
+    try:
+        await inter.response.defer(ephemeral=True)
+        defer_used = True
+    except:
+        defer_used = False
+    
+    try:
+        days = {"week": 7, "month": 30}.get(period)
+        ts = None if days is None else (now() - timedelta(days=days)).timestamp()
+        spool = await store.export(данные, формат, ts)
+        
+        with spool:
+            size = spool.seek(0, os.SEEK_END)
+            spool.seek(0)
+            if size > inter.guild.filesize_limit:
+                msg = f"❌ Файл слишком большой ({size // 1024 // 1024} МБ), выберите период короче"
+                if defer_used:
+                    await inter.followup.send(msg, ephemeral=True)
+                else:
+                    await inter.response.send_message(msg, ephemeral=True)
+                return
+            
+            file = discord.File(spool, filename=f"{данные}_{period}.{формат}.gz")
+            if defer_used:
+                await inter.followup.send("📦 Выгрузка готова", file=file, ephemeral=True)
+            else:
+                await inter.response.send_message("📦 Выгрузка готова", file=file, ephemeral=True)
+        
+        await log_action(
+            inter.guild, inter.user,
+            "📦 Экспорт данных",
+            f"Данные: {данные}\nФормат: {формат}\nПериод: {period}"
+        )
+            
+    except Exception as e:
+        print(f"❌ Ошибка в export_data: {e}")
+        try:
+            if defer_used:
+                await inter.followup.send("❌ Произошла ошибка при выполнении команды", ephemeral=True)
+            else:
+                await inter.response.send_message("❌ Произошла ошибка при выполнении команды", ephemeral=True)
+        except:
+            pass
+
 @tree.command(name="список_каптов", description="📜 История каптов", guild=discord.Object(GUILD_ID))
 @app_commands.describe(period="Период")
 @app_commands.choices(period=[
@@ -734,7 +2340,7 @@ async def list_capts(inter: discord.Interaction, period: str = "all"):
         defer_used = False
     
     try:
-        view = CaptsListView(inter.guild, period)
+        view = CaptsListView(period)
         embed = await view.create_embed()
         
         if defer_used:
@@ -752,14 +2358,138 @@ async def list_capts(inter: discord.Interaction, period: str = "all"):
         except:
             pass
 
+async def render_top_avg(guild: discord.Guild, ranking, period_text: str) -> discord.Embed:
+    """Embed топа по среднему урону за период"""
+    st = ranking.stats
+    users = [(uid, st[uid]) for uid in ranking.avg.top(10)]
+    
+    embed = discord.Embed(
+        title=f"🏆 ТОП-10 СРЕДНЕГО УРОНА",
+        description=f"*Статистика {period_text}*",
+        color=0x9b59b6,
+        timestamp=now()
+    )
+    
+    names = await member_names.resolve_many(guild, [int(uid) for uid, _ in users])
+    desc = ""
+    for i, (uid, data) in enumerate(users, 1):
+        name = names.get(int(uid)) or f"Игрок {uid}"
+        
+        avg = data["damage"] // data["games"]
+        
+        if i <= 3:
+            desc += f"{medal(i)} **{name}**\n"
+        else:
+            desc += f"`{i}.` **{name}**\n"
+        
+        desc += f"```Средний урон: {avg:,}\nИгр:         {data['games']}\nВсего урона: {data['damage']:,}```\n"
+    
+    embed.description = f"*Статистика {period_text}*\n\n" + desc
+    embed.set_footer(text="Минимум 3 игры для участия")
+    return embed
+
+async def render_top_quantile(guild: discord.Guild, ranking, period_text: str, metric: str) -> discord.Embed:
+    """Embed топа по медиане или 90-му перцентилю урона за период"""
+    q, title, label = {
+        "median": (0.5, "МЕДИАНЫ УРОНА", "Медиана:"),
+        "p90": (0.9, "90-ГО ПЕРЦЕНТИЛЯ УРОНА", "p90:    "),
+    }[metric]
+    rows = store.quantile_top(ranking, q, 10)
+    
+    embed = discord.Embed(
+        title=f"📐 ТОП-10 {title}",
+        color=0x9b59b6,
+        timestamp=now()
+    )
+    
+    names = await member_names.resolve_many(guild, [int(uid) for uid, _, _ in rows])
+    desc = ""
+    for i, (uid, value, games) in enumerate(rows, 1):
+        name = names.get(int(uid)) or f"Игрок {uid}"
+        
+        if i <= 3:
+            desc += f"{medal(i)} **{name}**\n"
+        else:
+            desc += f"`{i}.` **{name}**\n"
+        
+        desc += f"```{label}     {int(value):,}\nИгр:         {games}```\n"
+    
+    clan = store.damage_quantiles(ranking.ts)
+    embed.description = f"*Статистика {period_text}*\n\n" + desc
+    if clan:
+        embed.set_footer(text=f"Клан: медиана {int(clan[0]):,} • p90 {int(clan[1]):,} • Минимум 3 игры")
+    return embed
+
+async def render_top_form(guild: discord.Guild, rows: list, n: int) -> discord.Embed:
+    """Embed топа по среднему урону за последние n игр"""
+    embed = discord.Embed(
+        title=f"🔥 ТОП-10 ФОРМЫ",
+        color=0x9b59b6,
+        timestamp=now()
+    )
+    
+    names = await member_names.resolve_many(guild, [int(uid) for uid, _, _, _ in rows])
+    desc = ""
+    for i, (uid, games, damage, kills) in enumerate(rows, 1):
+        name = names.get(int(uid)) or f"Игрок {uid}"
+        
+        if i <= 3:
+            desc += f"{medal(i)} **{name}**\n"
+        else:
+            desc += f"`{i}.` **{name}**\n"
+        
+        desc += f"```Средний урон: {damage // games:,}\nИгр:         {games}\nКиллов:      {kills}```\n"
+    
+    embed.description = f"*Последние {n} игр каждого игрока*\n\n" + desc
+    embed.set_footer(text="Минимум 3 игры для участия")
+    return embed
+
+async def render_top_kills(guild: discord.Guild, ranking, period_text: str) -> discord.Embed:
+    """Embed топа по киллам за период"""
+    st = ranking.stats
+    users = [(uid, st[uid]) for uid in ranking.kills.top(10)]
+
+    embed = discord.Embed(
+        title=f"☠️ ТОП-10 ПО КИЛЛАМ",
+        description=f"*Статистика {period_text}*",
+        color=0xe74c3c,
+        timestamp=now()
+    )
+    
+    names = await member_names.resolve_many(guild, [int(uid) for uid, _ in users])
+    desc = ""
+    for i, (uid, data) in enumerate(users, 1):
+        name = names.get(int(uid)) or f"Игрок {uid}"
+        
+        if i <= 3:
+            desc += f"{medal(i)} **{name}**\n"
+        else:
+            desc += f"`{i}.` **{name}**\n"
+        
+        desc += f"```Киллов:      {data['kills']}\nИгр:         {data['games']}\nСредний урон: {data['damage']//data['games']:,}```\n"
+    
+    embed.description = f"*Статистика {period_text}*\n\n" + desc
+    return embed
+
 @tree.command(name="топ_средний", description="🏆 Топ по среднему урону", guild=discord.Object(GUILD_ID))
-@app_commands.describe(period="Период")
+@app_commands.describe(
+    period="Период",
+    last_n="Только последние игры каждого игрока (период не учитывается)",
+    метрика="По чему строить топ"
+)
 @app_commands.choices(period=[
     app_commands.Choice(name="За всё время", value="all"),
     app_commands.Choice(name="За неделю", value="week"),
     app_commands.Choice(name="За месяц", value="month")
+], last_n=[
+    app_commands.Choice(name="Последние 10 игр", value=10),
+    app_commands.Choice(name="Последние 20 игр", value=20)
+], метрика=[
+    app_commands.Choice(name="Средний урон", value="avg"),
+    app_commands.Choice(name="Медиана урона", value="median"),
+    app_commands.Choice(name="90-й перцентиль урона", value="p90")
 ])
-async def top_avg(inter: discord.Interaction, period: str = "all"):
+async def top_avg(inter: discord.Interaction, period: str = "all", last_n: int = None, метрика: str = "avg"):
     if not has_role(inter.user, VIEW_ROLES):
         return await inter.response.send_message("❌ Нет доступа", ephemeral=True)
     
@@ -770,54 +2500,54 @@ async def top_avg(inter: discord.Interaction, period: str = "all"):
         defer_used = False
     
     try:
+        if last_n:
+            key = ("топ_средний", f"last_{last_n}", 0, None)
+            embed = render_cache.get(key)
+            if embed is None:
+                versions = render_cache.versions()
+                rows = store.form_top(last_n, 10)
+                if not rows:
+                    if defer_used:
+                        await inter.followup.send("📭 Нет игроков с 3+ играми", ephemeral=True)
+                    else:
+                        await inter.response.send_message("📭 Нет игроков с 3+ играми", ephemeral=True)
+                    return
+                embed = await render_top_form(inter.guild, rows, last_n)
+                render_cache.put(key, embed, versions)
+            
+            if defer_used:
+                await inter.followup.send(embed=embed, ephemeral=True)
+            else:
+                await inter.response.send_message(embed=embed, ephemeral=True)
+            return
+        
         if period == "week":
-            capts = get_capts_in_period(7)
+            ranking = period_ranking(7)
             period_text = "за неделю"
         elif period == "month":
-            capts = get_capts_in_period(30)
+            ranking = period_ranking(30)
             period_text = "за месяц"
         else:
-            capts = load_capts()
+            ranking = period_ranking()
             period_text = "за всё время"
         
-        st = calculate_stats(capts)
-        filtered = {uid: d for uid, d in st.items() if d["games"] >= 3}
-        
-        if not filtered:
+        if not ranking.avg:
             if defer_used:
                 await inter.followup.send("📭 Нет игроков с 3+ играми", ephemeral=True)
             else:
                 await inter.response.send_message("📭 Нет игроков с 3+ играми", ephemeral=True)
             return
 
-        users = sorted(filtered.items(), key=lambda x: x[1]["damage"]/x[1]["games"], reverse=True)[:10]
-        
-        embed = discord.Embed(
-            title=f"🏆 ТОП-10 СРЕДНЕГО УРОНА",
-            description=f"*Статистика {period_text}*",
-            color=0x9b59b6,
-            timestamp=now()
-        )
-        
-        desc = ""
-        for i, (uid, data) in enumerate(users, 1):
-            try:
-                member = await inter.guild.fetch_member(int(uid))
-                name = member.display_name
-            except:
-                name = f"Игрок {uid}"
-            
-            avg = data["damage"] // data["games"]
-            
-            if i <= 3:
-                desc += f"{medal(i)} **{name}**\n"
+        # ranking.ts отличает новое окно недели/месяца от прежнего
+        key = ("топ_средний", period, 0, ranking.ts, метрика)
+        embed = render_cache.get(key)
+        if embed is None:
+            versions = render_cache.versions()
+            if метрика in ("median", "p90"):
+                embed = await render_top_quantile(inter.guild, ranking, period_text, метрика)
             else:
-                desc += f"`{i}.` **{name}**\n"
-            
-            desc += f"```Средний урон: {avg:,}\nИгр:         {data['games']}\nВсего урона: {data['damage']:,}```\n"
-        
-        embed.description = f"*Статистика {period_text}*\n\n" + desc
-        embed.set_footer(text="Минимум 3 игры для участия")
+                embed = await render_top_avg(inter.guild, ranking, period_text)
+            render_cache.put(key, embed, versions)
         
         if defer_used:
             await inter.followup.send(embed=embed, ephemeral=True)
@@ -853,16 +2583,16 @@ async def top_kills(inter: discord.Interaction, period: str = "all"):
     
     try:
         if period == "week":
-            capts = get_capts_in_period(7)
+            ranking = period_ranking(7)
             period_text = "за неделю"
         elif period == "month":
-            capts = get_capts_in_period(30)
+            ranking = period_ranking(30)
             period_text = "за месяц"
         else:
-            capts = load_capts()
+            ranking = period_ranking()
             period_text = "за всё время"
+        st = ranking.stats
         
-        st = calculate_stats(capts)
         
         if not st:
             if defer_used:
@@ -871,31 +2601,12 @@ async def top_kills(inter: discord.Interaction, period: str = "all"):
                 await inter.response.send_message("📭 Статистика пуста", ephemeral=True)
             return
 
-        users = sorted(st.items(), key=lambda x: x[1]["kills"], reverse=True)[:10]
-
-        embed = discord.Embed(
-            title=f"☠️ ТОП-10 ПО КИЛЛАМ",
-            description=f"*Статистика {period_text}*",
-            color=0xe74c3c,
-            timestamp=now()
-        )
-        
-        desc = ""
-        for i, (uid, data) in enumerate(users, 1):
-            try:
-                member = await inter.guild.fetch_member(int(uid))
-                name = member.display_name
-            except:
-                name = f"Игрок {uid}"
-            
-            if i <= 3:
-                desc += f"{medal(i)} **{name}**\n"
-            else:
-                desc += f"`{i}.` **{name}**\n"
-            
-            desc += f"```Киллов:      {data['kills']}\nИгр:         {data['games']}\nСредний урон: {data['damage']//data['games']:,}```\n"
-        
-        embed.description = f"*Статистика {period_text}*\n\n" + desc
+        key = ("топ_киллы", period, 0, ranking.ts)
+        embed = render_cache.get(key)
+        if embed is None:
+            versions = render_cache.versions()
+            embed = await render_top_kills(inter.guild, ranking, period_text)
+            render_cache.put(key, embed, versions)
         
         if defer_used:
             await inter.followup.send(embed=embed, ephemeral=True)
@@ -913,13 +2624,16 @@ async def top_kills(inter: discord.Interaction, period: str = "all"):
             pass
 
 @tree.command(name="моя_статистика", description="📊 Ваша статистика", guild=discord.Object(GUILD_ID))
-@app_commands.describe(period="Период")
+@app_commands.describe(period="Период", last_n="Показать форму за последние игры")
 @app_commands.choices(period=[
     app_commands.Choice(name="За всё время", value="all"),
     app_commands.Choice(name="За неделю", value="week"),
     app_commands.Choice(name="За месяц", value="month")
+], last_n=[
+    app_commands.Choice(name="Последние 10 игр", value=10),
+    app_commands.Choice(name="Последние 20 игр", value=20)
 ])
-async def my_stats(inter: discord.Interaction, period: str = "all"):
+async def my_stats(inter: discord.Interaction, period: str = "all", last_n: int = None):
     if not has_role(inter.user, VIEW_ROLES):
         return await inter.response.send_message("❌ Нет доступа", ephemeral=True)
     
@@ -931,16 +2645,16 @@ async def my_stats(inter: discord.Interaction, period: str = "all"):
     
     try:
         if period == "week":
-            capts = get_capts_in_period(7)
+            ranking = period_ranking(7)
             period_text = "за неделю"
         elif period == "month":
-            capts = get_capts_in_period(30)
+            ranking = period_ranking(30)
             period_text = "за месяц"
         else:
-            capts = load_capts()
+            ranking = period_ranking()
             period_text = "за всё время"
+        st = ranking.stats
         
-        st = calculate_stats(capts)
         uid = str(inter.user.id)
         
         if uid not in st:
@@ -967,11 +2681,8 @@ async def my_stats(inter: discord.Interaction, period: str = "all"):
             inline=False
         )
         
-        avg_users = sorted(st.items(), key=lambda x: x[1]["damage"]/x[1]["games"] if x[1]["games"] >= 3 else 0, reverse=True)
-        kills_users = sorted(st.items(), key=lambda x: x[1]["kills"], reverse=True)
-        
-        avg_pos = next((i+1 for i, (u, _) in enumerate(avg_users) if u == uid and data["games"] >= 3), None)
-        kills_pos = next((i+1 for i, (u, _) in enumerate(kills_users) if u == uid), None)
+        avg_pos = ranking.avg.rank(uid)
+        kills_pos = ranking.kills.rank(uid)
         
         positions = ""
         if avg_pos:
@@ -982,6 +2693,24 @@ async def my_stats(inter: discord.Interaction, period: str = "all"):
         if positions:
             embed.add_field(name="🎯 Позиции в рейтинге", value=positions, inline=False)
         
+        quantiles = store.damage_quantiles(ranking.ts, inter.user.id)
+        clan = store.damage_quantiles(ranking.ts)
+        if quantiles and clan:
+            embed.add_field(
+                name="📐 Распределение урона",
+                value=f"```Медиана:       {int(quantiles[0]):,}\np90:           {int(quantiles[1]):,}\nМедиана клана: {int(clan[0]):,}\np90 клана:     {int(clan[1]):,}```",
+                inline=False
+            )
+        
+        form = store.player_form(inter.user.id, last_n) if last_n else None
+        if form:
+            games, damage, kills = form
+            embed.add_field(
+                name=f"🔥 Форма: последние {last_n} игр",
+                value=f"```Игр:          {games}\nСредний урон:  {damage // games:,}\nСредние киллы: {kills / games:.1f}```",
+                inline=False
+            )
+        
         if defer_used:
             await inter.followup.send(embed=embed, ephemeral=True)
         else:
@@ -997,6 +2726,82 @@ async def my_stats(inter: discord.Interaction, period: str = "all"):
         except:
             pass
 
+@tree.command(name="история_игрока", description="📜 Капты игрока", guild=discord.Object(GUILD_ID))
+@app_commands.describe(игрок="@упоминание или ID (по умолчанию - вы)")
+@app_commands.autocomplete(игрок=player_autocomplete)
+async def player_history(inter: discord.Interaction, игрок: str = None):
+    if not has_role(inter.user, VIEW_ROLES):
+        return await inter.response.send_message("❌ Нет доступа", ephemeral=True)
+    
+    if игрок is None:
+        user_id = inter.user.id
+    else:
+        mention_text = игрок.strip()
+        try:
+            user_id = int(mention_text.strip("<@!>"))
+        except:
+            return await inter.response.send_message("❌ Используйте @упоминание или ID", ephemeral=True)
+    
+    try:
+        await inter.response.defer(ephemeral=True)
+        defer_used = True
+    except:
+        defer_used = False
+    
+    try:
+        view = PlayerHistoryView(user_id)
+        embed = await view.create_embed(inter.guild)
+        
+        if defer_used:
+            await inter.followup.send(embed=embed, view=view, ephemeral=True)
+        else:
+            await inter.response.send_message(embed=embed, view=view, ephemeral=True)
+            
+    except Exception as e:
+        print(f"❌ Ошибка в player_history: {e}")
+        try:
+            if defer_used:
+                await inter.followup.send("❌ Произошла ошибка при выполнении команды", ephemeral=True)
+            else:
+                await inter.response.send_message("❌ Произошла ошибка при выполнении команды", ephemeral=True)
+        except:
+            pass
+
+@tree.command(name="статистика_против", description="⚔️ Статистика против семьи", guild=discord.Object(GUILD_ID))
+@app_commands.describe(семья="Название семьи-противника")
+async def opponent_stats(inter: discord.Interaction, семья: str):
+    if not has_role(inter.user, VIEW_ROLES):
+        return await inter.response.send_message("❌ Нет доступа", ephemeral=True)
+    
+    data = store.opponent_stats(семья)
+    if data is None:
+        return await inter.response.send_message(f"📭 Каптов против **{семья}** нет", ephemeral=True)
+    
+    total = data["wins"] + data["losses"]
+    winrate = data["wins"] / total * 100
+    
+    embed = discord.Embed(
+        title=f"⚔️ Семья vs {data['name']}",
+        color=0xe74c3c,
+        timestamp=now()
+    )
+    embed.add_field(
+        name="📊 Результаты",
+        value=f"```Каптов:    {total}\nПобед:     {data['wins']}\nПоражений: {data['losses']}\nВинрейт:   {winrate:.1f}%```",
+        inline=False
+    )
+    embed.add_field(
+        name="💥 Урон и киллы",
+        value=f"```Всего урона:   {data['damage']:,}\nВсего киллов:  {data['kills']}\nУрон за капт:  {data['damage'] // total:,}```",
+        inline=False
+    )
+    
+    await inter.response.send_message(embed=embed, ephemeral=True)
+
+@opponent_stats.autocomplete("семья")
+async def opponent_autocomplete(inter: discord.Interaction, current: str):
+    return [app_commands.Choice(name=name[:100], value=name[:100]) for name in store.opponents_by_prefix(current)]
+
 @tree.command(name="справка", description="📚 Помощь по командам", guild=discord.Object(GUILD_ID))
 async def help_cmd(inter: discord.Interaction):
     is_admin = has_role(inter.user, ADMIN_ROLES)
@@ -1015,6 +2820,8 @@ async def help_cmd(inter: discord.Interaction):
             "`/топ_средний` - Топ по урону\n"
             "`/топ_киллы` - Топ по киллам\n"
             "`/моя_статистика` - Ваша стата\n"
+            "`/история_игрока` - Капты игрока\n"
+            "`/статистика_против` - Итоги против семьи\n"
             "`/справка` - Эта справка"
         ),
         inline=False
@@ -1030,6 +2837,7 @@ async def help_cmd(inter: discord.Interaction):
                 "`/загрузить_каптов` - Загрузить из файла\n"
                 "`/удалить_капт` - Удалить капт\n"
                 "`/сбросить_статистику` - Сброс всего\n"
+                "`/экспорт` - Выгрузка данных файлом\n"
                 "`/sync` - Синхронизация команд"
             ),
             inline=False
@@ -1095,12 +2903,60 @@ async def sync_commands(inter: discord.Interaction):
         await inter.response.send_message(embed=embed, ephemeral=True)
 
 # ==================== АВТООБНОВЛЕНИЕ ====================
+_published = {}  # ID канала -> (хэш табло без времени, когда отправлено)
+
+def board_digest(fields: dict) -> int:
+    """Хэш содержимого табло без метки времени"""
+    embed = fields["embed"].to_dict()
+    embed.pop("timestamp", None)
+    return hash(json.dumps(embed, sort_keys=True, ensure_ascii=False))
+
+async def publish_board(channel, title: str, **fields) -> bool:
+    """Обновить табло в канале: правка по сохранённому ID, иначе поиск или новое сообщение.
+
+    Табло с тем же содержимым не переписывается, пока не пройдёт
+    BOARD_TIMESTAMP_REFRESH. Возвращает True, если было изменено
+    существующее сообщение; если табло не удалось ни изменить, ни
+    отправить, ошибка пробрасывается вызывающему.
+    """
+    digest = board_digest(fields)
+    last = _published.get(channel.id)
+    if last and last[0] == digest and time.monotonic() - last[1] < BOARD_TIMESTAMP_REFRESH:
+        return False
+
+    message_id = store.boards.get(str(channel.id))
+    if message_id:
+        try:
+            await channel.get_partial_message(message_id).edit(**fields)
+            _published[channel.id] = (digest, time.monotonic())
+            return True
+        except discord.NotFound:
+            pass
+
+    # Сохранённого сообщения нет - ищем его в истории канала (разово)
+    async for msg in channel.history(limit=50):
+        if msg.author.id == client.user.id and msg.embeds:
+            if title in (msg.embeds[0].title or ""):
+                try:
+                    await msg.edit(**fields)
+                    await store.set_board_message(channel.id, msg.id)
+                    _published[channel.id] = (digest, time.monotonic())
+                    return True
+                except:
+                    pass
+
+    msg = await channel.send(**fields)
+    await store.set_board_message(channel.id, msg.id)
+    _published[channel.id] = (digest, time.monotonic())
+    print(f"✅ Табло «{title}» отправлено")
+    return False
+
 async def update_avg_top():
     channel = client.get_channel(STATS_AVG_CHANNEL_ID)
     if not channel:
         return
 
-    st = load_stats()
+    st = store.stats
     filtered = {uid: d for uid, d in st.items() if d["games"] >= 3}
     if not filtered:
         return
@@ -1113,13 +2969,10 @@ async def update_avg_top():
         timestamp=now()
     )
 
+    names = await member_names.resolve_many(channel.guild, [int(uid) for uid, _ in users])
     desc = ""
     for i, (uid, data) in enumerate(users, 1):
-        try:
-            member = await channel.guild.fetch_member(int(uid))
-            name = member.display_name
-        except:
-            name = f"Игрок {uid}"
+        name = names.get(int(uid)) or f"Игрок {uid}"
 
         avg = data["damage"] // data["games"]
         leader_avg = users[0][1]["damage"] // users[0][1]["games"]
@@ -1131,26 +2984,14 @@ async def update_avg_top():
     embed.description = desc
     embed.set_footer(text="Обновляется каждый час • Минимум 3 игры")
 
-    async for msg in channel.history(limit=50):
-        if msg.author.id == client.user.id and msg.embeds:
-            if "ТОП-10 СРЕДНЕГО УРОНА" in msg.embeds[0].title:
-                try:
-                    await msg.edit(embed=embed)
-                    return
-                except:
-                    pass
-
-    try:
-        await channel.send(embed=embed)
-    except:
-        pass
+    await publish_board(channel, "ТОП-10 СРЕДНЕГО УРОНА", embed=embed)
 
 async def update_kills_top():
     channel = client.get_channel(STATS_KILLS_CHANNEL_ID)
     if not channel:
         return
 
-    st = load_stats()
+    st = store.stats
     if not st:
         return
 
@@ -1162,13 +3003,10 @@ async def update_kills_top():
         timestamp=now()
     )
 
+    names = await member_names.resolve_many(channel.guild, [int(uid) for uid, _ in users])
     desc = ""
     for i, (uid, data) in enumerate(users, 1):
-        try:
-            member = await channel.guild.fetch_member(int(uid))
-            name = member.display_name
-        except:
-            name = f"Игрок {uid}"
+        name = names.get(int(uid)) or f"Игрок {uid}"
 
         leader_kills = users[0][1]["kills"]
         percent = (data["kills"] / leader_kills * 100) if leader_kills > 0 else 0
@@ -1179,52 +3017,89 @@ async def update_kills_top():
     embed.description = desc
     embed.set_footer(text="Обновляется каждый час")
 
-    async for msg in channel.history(limit=50):
-        if msg.author.id == client.user.id and msg.embeds:
-            if "ТОП-10 ПО КИЛЛАМ" in msg.embeds[0].title:
-                try:
-                    await msg.edit(embed=embed)
-                    return
-                except:
-                    pass
-
-    try:
-        await channel.send(embed=embed)
-    except:
-        pass
+    await publish_board(channel, "ТОП-10 ПО КИЛЛАМ", embed=embed)
 
 async def update_capts_list():
     channel = client.get_channel(CAPTS_LIST_CHANNEL_ID)
     if not channel:
         return
 
-    view = CaptsListView(channel.guild, "all")
+    view = CaptsListView("all")
     embed = await view.create_embed()
 
-    async for msg in channel.history(limit=50):
-        if msg.author.id == client.user.id and msg.embeds:
-            if "История каптов" in msg.embeds[0].title:
-                try:
-                    await msg.edit(embed=embed, view=view)
-                    print("✅ Список каптов обновлён")
-                    return
-                except:
-                    pass
+    if await publish_board(channel, "История каптов", embed=embed, view=view):
+        print("✅ Список каптов обновлён")
+
+class LeaderboardRefresher:
+    """Отложенное обновление табло в каналах.
+
+    Команды только помечают табло устаревшими; все запросы за REFRESH_DELAY
+    секунд объединяются в одно обновление, и каждое табло обновляет не
+    больше одной задачи одновременно. Табло не пересобирается, если с
+    прошлого раза не менялись ни данные, ни имена участников.
+    """
+
+    def __init__(self, boards: dict):
+        self.boards = boards  # имя -> корутина обновления
+        self._dirty = set()
+        self._task = None
+        self._built = {}  # имя -> (версии данных и имён, когда собрано)
+
+    def request(self, *names):
+        """Пометить табло для обновления (без аргументов - все)"""
+        self._dirty.update(names or self.boards)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def wait(self):
+        """Дождаться выполнения запрошенных обновлений"""
+        if self._task is not None:
+            await asyncio.shield(self._task)
+
+    async def _run(self):
+        # Запросы, пришедшие во время обновления, обрабатываются следующим кругом
+        while self._dirty:
+            await asyncio.sleep(REFRESH_DELAY)
+            dirty, self._dirty = self._dirty, set()
+            await asyncio.gather(*(self._refresh(name) for name in dirty))
+
+    async def _refresh(self, name: str):
+        versions = (store.version, member_names.version)
+        built = self._built.get(name)
+        if built and built[0] == versions and time.monotonic() - built[1] < BOARD_TIMESTAMP_REFRESH:
+            return
+        try:
+            await self.boards[name]()
+            self._built[name] = (versions, time.monotonic())
+        except Exception as e:
+            print(f"❌ Ошибка обновления табло {name}: {e}")
 
-    try:
-        await channel.send(embed=embed, view=view)
-        print("✅ Список каптов отправлен")
-    except:
-        pass
+leaderboards = LeaderboardRefresher({
+    "capts": update_capts_list,
+    "avg": update_avg_top,
+    "kills": update_kills_top,
+})
 
 @tasks.loop(hours=1)
 async def auto_update():
-    await update_avg_top()
-    await update_kills_top()
-    await update_capts_list()
+    leaderboards.request()
+    await leaderboards.wait()
     print(f"✅ Автообновление выполнено: {datetime.now().strftime('%H:%M:%S')}")
 
 # ==================== СОБЫТИЯ ====================
+@client.event
+async def setup_hook():
+    # Кнопки списков каптов обрабатываются по шаблону custom_id
+    client.add_dynamic_items(CaptsPageButton, HistoryPageButton)
+    
+    # SIGTERM закрывает бота штатно, чтобы несохранённые данные попали на диск
+    try:
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, lambda: asyncio.create_task(client.close())
+        )
+    except NotImplementedError:
+        pass
+
 @client.event
 async def on_ready():
     print(f"✅ Бот запущен: {client.user}")
@@ -1235,27 +3110,48 @@ async def on_ready():
     except Exception as e:
         print(f"❌ Ошибка синхронизации: {e}")
     
+    # Кэш имён и индекс для автодополнения заполняются из кэша участников шлюза
+    for guild in client.guilds:
+        for member in guild.members:
+            member_names.put(member.id, member.display_name)
+            roster.set(member.id, member.display_name)
+    
     if not auto_update.is_running():
         auto_update.start()
         print("✅ Автообновление запущено")
 
+@client.event
+async def on_member_join(member: discord.Member):
+    member_names.put(member.id, member.display_name)
+    roster.set(member.id, member.display_name)
+
+@client.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    if before.display_name != after.display_name:
+        member_names.put(after.id, after.display_name)
+        roster.set(after.id, after.display_name)
+
+@client.event
+async def on_user_update(before: discord.User, after: discord.User):
+    # Смена глобального имени меняет display_name участников без ника
+    for guild in client.guilds:
+        member = guild.get_member(after.id)
+        if member is not None:
+            member_names.put(member.id, member.display_name)
+            roster.set(member.id, member.display_name)
+
 @client.event
 async def on_member_remove(member: discord.Member):
-    st = load_stats()
-    uid = str(member.id)
-    
-    if uid in st:
-        del st[uid]
-        save_stats(st)
-        
+    member_names.discard(member.id)
+    roster.remove(member.id)
+    if await store.remove_player_stats(member.id):
         await log_action(
             member.guild, client.user,
             "👋 Игрок покинул сервер",
             f"{member.mention} ({member.display_name})\nСтатистика удалена"
         )
         
-        asyncio.create_task(update_avg_top())
-        asyncio.create_task(update_kills_top())
+        leaderboards.request("avg", "kills")
 
 # ==================== ЗАПУСК ====================
 if __name__ == "__main__":
@@ -1265,4 +3161,15 @@ if __name__ == "__main__":
                 json.dump({} if db == DB_STATS else [], f)
             print(f"📁 Создан {db}")
 
-    client.run(TOKEN)
+    async def main():
+        await store.load()
+        try:
+            async with client:
+                await client.start(TOKEN)
+        finally:
+            # Гарантированная запись несохранённых изменений при остановке
+            await store.close()
+            shutdown_workers()
+
+    discord.utils.setup_logging()
+    asyncio.run(main())